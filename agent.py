@@ -7,8 +7,10 @@ class Agent:
         self.world = world      # My representation of the world
         # world.size and world.walls are filled, remaining fields are empty!
         
-        self.body = body        # List of body positions. body[0] is the head
-        self.nutrients = {}     # Dict representing nutrient stock
+        self.body = body        # Sequence of body positions. body[0] is the head
+        self.nutrients = {}     # Mapping representing nutrient stock
+        # (Each turn, the game replaces .body with a tuple and .nutrients with
+        # a read-only mapping: they are snapshots, not to be modified.)
         self.age = 0            # number of cycles this agent has lived so far
         self.timespent = 0.0    # seconds spent by previous call to chooseAction
         
@@ -20,7 +22,7 @@ class Agent:
         # It must return an action (one of the ACTIONS),
         # and a message (a possibly empty bytes object) to send to the other agent.
         # (You may want to use pickle.dumps / pickle.loads to convert
-        # objects to bytes and back.)
+        # objects to bytes and back, or msgcodec for much shorter messages.)
         
         action = Stay
         msg = b""       # an empty message costs nothing
@@ -0,0 +1,199 @@
+# Calibration of the game timeslot to the speed of the host.
+#
+# The time an agent may think is proportional to the timeslot, which was
+# chosen for a reference machine.  With calibration, the timeslot is scaled
+# by how much slower (or faster) this host runs a fixed benchmark kernel:
+#
+#     timeslot *= calibration.factor()
+#
+# The kernel does the kind of work agents do each turn: path searches on a
+# map with walls, point arithmetic and dict lookups.  It is deterministic
+# (fixed map and queries).  A single run takes some milliseconds, short
+# enough for scheduler and cache jitter to dominate, so each sample times
+# as many runs as take at least MINSAMPLE seconds of CPU time.  The result
+# is the median time per run of several samples (which is not disturbed by
+# a few slow ones), with a distribution-free 95% confidence interval.
+#
+# Measuring takes a second or two, so the result is cached per host in a
+# small JSON file (in $LONGLIFECACHE or ~/.cache/longlife, like the map
+# cache) and reused until it expires.  A result whose samples are spread
+# by more than MAXSPREAD (a busy host) is used, but not cached.
+#
+# Run this module as a script to measure again and show the result:
+#   python3 calibration.py
+
+from collections import namedtuple
+import platform
+import logging
+import random
+import socket
+import json
+import math
+import time
+import os
+
+from world import *
+import pathfinding
+import mapcache
+
+# Kernel version (cached results of other versions are ignored):
+VERSION = 2
+# Median kernel time on the reference machine (s).  Derived from the old
+# calibration loop (v1.5, with the v1.5 World), which took 0.068 s there:
+# the median of 15 interleaved runs of each on one host gives this kernel
+# 0.200 times the time of that loop (0.188 to 0.236).
+REFERENCE = 0.0136
+# Seed of the benchmark map and queries:
+SEED = 20171106
+# Number of samples (after a warm-up run):
+REPEAT = 11
+# Minimum CPU time of a sample (s):
+MINSAMPLE = 0.1
+# Results with (slowest - fastest sample)/median above this are not cached:
+MAXSPREAD = 0.15
+# Cached results expire after this time (s):
+MAXAGE = 24*3600
+
+# Confidence level of the interval:
+CONFIDENCE = 0.95
+
+
+class Calibration(namedtuple("Calibration", ['time', 'low', 'high', 'samples', 'spread', 'host', 'timestamp'])):
+    """Result of a calibration: the median kernel time (s), the bounds of
+    its confidence interval, the number of samples, their relative spread
+    ((slowest - fastest)/median), the host name and when it was measured
+    (time.time()).
+    """
+
+    __slots__ = ()
+
+    def factor(self):
+        """Factor to scale the timeslot by."""
+        return self.time/REFERENCE
+
+    def stable(self):
+        """Whether the samples agree well enough for the result to be reused."""
+        return self.spread <= MAXSPREAD
+
+
+class Benchmark:
+    """The benchmark kernel, with its map and queries."""
+
+    def __init__(self, seed=SEED, queries=75):
+        self.world = World(Point(60,40), seed, grid=True)
+        self.world.generateWalls(15)
+        self.grid = pathfinding.Grid(self.world)
+        rnd = random.Random(seed)
+        free = [self.grid.point(i) for i in range(len(self.grid.passable)) if self.grid.passable[i]]
+        self.queries = [(rnd.choice(free), rnd.choice(free)) for _ in range(queries)]
+
+    def run(self, runs=1):
+        """Run the kernel runs times and return the CPU time per run (s)."""
+        t = time.process_time()
+        for _ in range(runs):
+            self.kernel()
+        return (time.process_time() - t)/runs
+
+    def kernel(self):
+        world = self.world
+        grid = self.grid
+        for (start, goal) in self.queries:
+            path = pathfinding.astar(grid, start, goal)
+            # Follow the path, checking the surroundings as agents do
+            p = start
+            for q in path:
+                for d in DIRECTIONS:
+                    n = world.translate(p, d)
+                    if n not in world.walls and world.dist(n, goal) < world.dist(p, goal):
+                        break
+                p = q
+        pathfinding.bfs(grid, self.queries[0][0], self.queries[0][1])
+
+
+def measure(repeat=REPEAT, minsample=MINSAMPLE):
+    """Time repeat samples of the kernel (each of at least minsample
+    seconds) and return a Calibration."""
+    benchmark = Benchmark()
+    t = benchmark.run()     # warm-up (the first run is usually slower)
+    runs = max(1, int(math.ceil(minsample/max(t, 1e-6))))
+    samples = sorted(benchmark.run(runs) for _ in range(repeat))
+    n = len(samples)
+    median = (samples[(n-1)//2] + samples[n//2])/2
+    k = medianRank(n)
+    return Calibration(median, samples[k], samples[n-1-k], n, (samples[-1] - samples[0])/median,
+                       socket.gethostname(), time.time())
+
+def medianRank(n, confidence=CONFIDENCE):
+    """Index k such that (sorted samples[k], samples[n-1-k]) is a confidence
+    interval for the median of n samples (from the binomial distribution)."""
+    k = 0
+    tail = 0.5**n   # P(fewer than k+1 samples below the median)
+    while k + 1 < n - 1 - k and 2*(tail + comb(n, k+1)*0.5**n) <= 1 - confidence:
+        k += 1
+        tail += comb(n, k)*0.5**n
+    return k
+
+def comb(n, k):
+    return math.factorial(n)//(math.factorial(k)*math.factorial(n-k))
+
+
+def cacheFile():
+    """Name of the file with the cached calibration of this host."""
+    directory = os.environ.get("LONGLIFECACHE", mapcache.DEFAULTDIR)
+    return os.path.join(directory, "calibration-{}.json".format(socket.gethostname()))
+
+def load(maxage=MAXAGE):
+    """Return the cached Calibration of this host, or None if missing or expired."""
+    try:
+        with open(cacheFile()) as f:
+            data = json.load(f)
+        if data.pop('version') != VERSION or data.pop('python') != platform.python_version():
+            return None
+        result = Calibration(**data)
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        logging.debug("No cached calibration: {}".format(e))
+        return None
+    if not 0 <= time.time() - result.timestamp < maxage:
+        return None
+    return result
+
+def store(result):
+    """Cache a Calibration for this host.  Failures are not fatal."""
+    filename = cacheFile()
+    data = dict(result._asdict(), version=VERSION, python=platform.python_version())
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmpname, "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmpname, filename)
+    except OSError as e:
+        logging.warning("Could not write calibration {}: {}".format(filename, e))
+
+def calibration(maxage=MAXAGE):
+    """Return the Calibration of this host (cached, or measured now)."""
+    result = load(maxage)
+    if result is None:
+        result = measure()
+        if result.stable():
+            store(result)
+        else:
+            logging.warning("Calibration samples spread by {:.0%}: not cached".format(result.spread))
+    logging.info("Calibration: {:.6f} s ({:.0%} CI {:.6f}--{:.6f}, n={}, spread {:.1%}), factor {:.3f}".format(
+        result.time, CONFIDENCE, result.low, result.high, result.samples, result.spread, result.factor()))
+    return result
+
+def factor(maxage=MAXAGE):
+    """Factor to scale the timeslot by, on this host."""
+    return calibration(maxage).factor()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(levelname)s:\t%(message)s', level=logging.INFO)
+    result = measure()
+    if result.stable():
+        store(result)
+        assert load() == result
+    print("{}: kernel {:.6f} s, {:.0%} CI [{:.6f}, {:.6f}] (n={}, spread {:.1%}{}), factor {:.3f}".format(
+        result.host, result.time, CONFIDENCE, result.low, result.high, result.samples, result.spread,
+        "" if result.stable() else ", not cached", result.factor()))
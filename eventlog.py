@@ -0,0 +1,131 @@
+# Structured binary log of the per-turn events of a game.
+#
+# Logging every turn as text (start.py -d 1) is slow and hard to analyse.
+# An EventLog attached to an AgentGame (AgentGame(..., eventlog="game.lle"),
+# or start.py -e game.lle) writes each event as a fixed-size EVENT record
+# (after a small HEADER) instead:
+#
+#   kind        player  a                       b                       x
+#   turn        n       action (-1: invalid)    bytes sent              time spent (s)
+#   consume     n       S consumed              M consumed              -
+#   eat         n       food type (FOODTYPES)   cell of the new food    -
+#   rendezvous  n       number of players       -                       -
+#   death       n       cause (replay.CAUSES)   -                       -
+#   foodmove    255     cell from               cell to                 -
+#
+# (cells are grid indices, see World.index).  Read the log with readEvents,
+# or run this module as a script to summarize a log:
+#   python3 eventlog.py game.lle
+# or, without arguments, to run the tests.
+
+from collections import namedtuple, Counter
+import struct
+import sys
+
+from world import *
+from replay import CAUSES
+
+VERSION = 1
+MAGIC = b"LLEV"
+# magic, version, width, height
+HEADER = struct.Struct('<4sHHH')
+# round, player, kind, a, b, x
+EVENT = struct.Struct('<IBBiif')
+
+KINDS = ["turn", "consume", "eat", "rendezvous", "death", "foodmove"]
+(TURN, CONSUME, EAT, RENDEZVOUS, DEATH, FOODMOVE) = range(len(KINDS))
+# Player number of events that do not belong to a player:
+NOPLAYER = 255
+
+
+class Event(namedtuple("Event", ['round', 'player', 'kind', 'a', 'b', 'x'])):
+    """An event read from a log (kind is one of KINDS)."""
+
+    __slots__ = ()
+
+
+class EventLog:
+    """Writes the events of an AgentGame to a file."""
+
+    def __init__(self, filename, game):
+        self.game = game
+        self.file = open(filename, "wb", buffering=1 << 16)
+        (W, H) = game.world.size
+        self.file.write(HEADER.pack(MAGIC, VERSION, W, H))
+        self.pack = EVENT.pack
+        self.write = self.file.write
+
+    def event(self, player, kind, a=0, b=0, x=0.0):
+        """Write an event of player (an index, or NOPLAYER) in the current round."""
+        self.write(self.pack(self.game.rounds, player, kind, a, b, x))
+
+    def turn(self, player, action):
+        outbox = player.outbox
+        self.event(self.game.allPlayers.index(player), TURN, ACTIONS.index(action) if action in ACTIONS else -1,
+                   len(outbox) if isinstance(outbox, bytes) else -1, player.timespent)
+
+    def consume(self, player, S, M):
+        self.event(self.game.allPlayers.index(player), CONSUME, S, M)
+
+    def eat(self, player, t, p):
+        self.event(self.game.allPlayers.index(player), EAT, FOODTYPES.index(t), self.game.world.index(p))
+
+    def rendezvous(self, player, players):
+        self.event(self.game.allPlayers.index(player), RENDEZVOUS, len(players))
+
+    def death(self, player):
+        self.event(self.game.allPlayers.index(player), DEATH, CAUSES.index(player.deathCause))
+
+    def foodMoved(self, p, p2):
+        index = self.game.world.index
+        self.event(NOPLAYER, FOODMOVE, index(p), index(p2))
+
+    def close(self):
+        self.file.close()
+
+
+def readEvents(filename):
+    """Generate the Events in a log file."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    (magic, version, W, H) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{}: unknown format".format(filename))
+    end = len(data) - (len(data) - HEADER.size) % EVENT.size     # (ignore a truncated event)
+    for (r, player, kind, a, b, x) in EVENT.iter_unpack(data[HEADER.size:end]):
+        yield Event(r, player, KINDS[kind], a, b, x)
+
+
+## TESTS (or summarize a log)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        counts = Counter()
+        for e in readEvents(sys.argv[1]):
+            counts[e.kind, e.player] += 1
+            if e.kind == "death":
+                print("round {}: P{} died ({})".format(e.round, e.player, CAUSES[e.a]))
+        for (kind, player), n in sorted(counts.items()):
+            print("{:12} {:>4} {:8d}".format(kind, "-" if player == NOPLAYER else "P{}".format(player), n))
+        sys.exit()
+
+    import tempfile
+    import os
+    from game import AgentGame
+    from agent1 import Agent1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "test.lle")
+        game = AgentGame(Agent1, seeds=("events", "test"), savemap=None, eventlog=filename)
+        score = game.start()
+        events = list(readEvents(filename))
+        print("Game: score={} rounds={} events={} log={} bytes".format(
+            score, game.rounds, len(events), os.path.getsize(filename)))
+        counts = Counter(e.kind for e in events)
+        assert counts["turn"] == sum(p.age for p in game.allPlayers)
+        assert counts["foodmove"] > 0 and counts["consume"] > 0
+        deaths = {e.player: CAUSES[e.a] for e in events if e.kind == "death"}
+        assert deaths == {n: p.deathCause for n, p in enumerate(game.allPlayers)}, deaths
+        assert all(e.round <= game.rounds for e in events)
+        assert [e.round for e in events] == sorted(e.round for e in events)
+    print("OK")
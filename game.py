@@ -30,26 +30,89 @@
 
 import sys
 import logging
-import copy
 from collections import namedtuple, ChainMap, Counter
-import pygame
-from pygame.locals import *
-import time
+from types import MappingProxyType
+import threading
+try:
+    import pygame   # only needed to show the game (or to load maps that are not BMP)
+except ImportError:
+    pygame = None
 
 from world import *
+from timelimit import TimeLimit
+from sandbox import AgentProcess
+from replay import Recorder
+from profiler import NULLPROFILER
+from eventlog import EventLog
+import mapfile
+import calibration
 #from agent import Agent
 
+# (Log messages are formatted lazily, and those built on every turn only
+# when their level is enabled, so headless runs do not pay for them.)
+logger = logging.getLogger()
+
+# Frames per second shown after the game is over (while waiting to close):
+IDLEFPS = 10
+
+# Modes of checking the bodies invariant (see AgentGame.checkBodies):
+#   off:         never
+#   incremental: after each move, only the cells it changed
+#   sampled:     all bodies, every checkEvery rounds
+#   full:        all bodies, after each action (for tests)
+CHECKMODES = ("off", "incremental", "sampled", "full")
+CHECKEVERY = 100
+
+def parseChecks(arg):
+    """Parse a checks option, "mode" or "sampled:N", into (mode, checkEvery).
+    Raises ValueError if it is not valid."""
+    (checks, sep, n) = arg.partition(":")
+    if checks not in CHECKMODES:
+        raise ValueError("unknown mode {!r} (not in {})".format(checks, CHECKMODES))
+    if not sep:
+        return (checks, CHECKEVERY)
+    if checks != "sampled":
+        raise ValueError("an interval only applies to the sampled mode")
+    if not n.isdigit() or int(n) <= 0:
+        raise ValueError("the interval must be a positive integer, not {!r}".format(n))
+    return (checks, int(n))
+
+
+class Proprioception(namedtuple("Proprioception", ['age', 'body', 'nutrients', 'timespent'])):
+    """An immutable snapshot of what a player knows about itself.
+
+    body is a tuple of positions (body[0] is the head),
+    nutrients is a read-only mapping of nutrient stocks.
+    """
+
+    __slots__ = ()
+
+
+class Snapshot(namedtuple("Snapshot", ['food', 'players', 'stats', 'gameover'])):
+    """An immutable picture of the game state, published for show.
+
+    food is a tuple of (position, type) pairs,
+    players is a tuple of (body, M, S) triples, one per player,
+    stats is the text of the stats line.
+    """
+
+    __slots__ = ()
+
 
 class Player:
-    def __init__(self, name, body, world, AgentClass, seed=None):
+    def __init__(self, name, body, world, AgentClass, seed=None, sandbox=False):
         self.name = name
-        self.body = body[:]
+        self.body = tuple(body)     # immutable, so it may be shared with the agent
         self.world = world
         self.age = 0
         
-        agentWorld = World(world.size, seed=seed)
+        agentWorld = World(world.size, seed=seed, grid=world.grid is not None)
         agentWorld.walls.update(world.walls)
-        self.agent = AgentClass(name, body[:], agentWorld)
+        if sandbox:
+            # Run the agent in its own process
+            self.agent = AgentProcess(AgentClass, name, body[:], agentWorld)
+        else:
+            self.agent = AgentClass(name, body[:], agentWorld)
         
         self.nutrients = {}
         self.nutrients['M'] = 1000
@@ -58,17 +121,35 @@ class Player:
         self.horizon = 20
         
         self.outbox = b""
+        self.failure = None     # why the agent failed to choose an action
+        self.deathCause = None  # why the player died (None while alive)
         
     def filterVision(self, env):
         """Return only the parts of the environment which are visible."""
-        return {p:v for p,v in env.items() if self.world.dist(p, self.body[0]) <= self.horizon}  
+        return HorizonView(self.world, env, self.body[0], self.horizon)
+
+    def vision(self):
+        """Return what the player sees this tick."""
+        return Vision(self.filterVision(self.world.bodies), self.filterVision(self.world.food))
+
+    def timeLimit(self, limit):
+        """Context manager that limits the CPU time of the agent in its block."""
+        if isinstance(self.agent, AgentProcess):
+            return self.agent.timeLimit(limit)
+        return TimeLimit(limit)
+
+    def close(self):
+        """Release resources held by the agent (e.g., its process)."""
+        if isinstance(self.agent, AgentProcess):
+            self.agent.close()
+
+    def proprioception(self):
+        """Return an immutable snapshot of the player's state."""
+        return Proprioception(self.age, self.body, MappingProxyType(dict(self.nutrients)), self.timespent)
 
     def transferInfo(self):
         """Transfer proprioception from player into corresponding agent."""
-        self.agent.age = self.age
-        self.agent.body = copy.deepcopy(self.body)
-        self.agent.nutrients = copy.deepcopy(self.nutrients)
-        self.agent.timespent = self.timespent
+        (self.agent.age, self.agent.body, self.agent.nutrients, self.agent.timespent) = self.proprioception()
     
     @staticmethod
     def redistributeNutrients(players):
@@ -99,26 +180,24 @@ class AgentGame:
             filename=None, walls=15,
             foodquant=4, timeslot=0.020, calibrate=False,
             visual=False, fps=25, tilesize=20,
-            seeds=(None, None)):
+            seeds=(None, None), savemap="currentmap.bmp", sandbox=False,
+            threaded=False, record=None, profiler=None,
+            checks="incremental", checkEvery=CHECKEVERY, eventlog=None):
         
-        logging.info("Original timeslot: {:.6f} s".format(timeslot))
+        logging.info("Original timeslot: %.6f s", timeslot)
         if calibrate:
-            # Call 3 times and choose minimum (first time is usually higher)
-            TCAL = min([self.calibrationTime(),
-                        self.calibrationTime(),
-                        self.calibrationTime()])
-            timeslot *= TCAL/0.068
-        logging.info("Adjusted timeslot: {:.6f} s".format(timeslot))
+            # Scale by the speed of this host (measured once, then cached)
+            timeslot *= calibration.factor()
+        logging.info("Adjusted timeslot: %.6f s", timeslot)
 
         if filename != None:
-            logging.info("Loading {} ...".format(filename))
-            image = pygame.image.load(filename)
-            pxarray = pygame.PixelArray(image)
-            width = len(pxarray)
-            height = len(pxarray[0])
+            logging.info("Loading %s ...", filename)
+            field = mapfile.load(filename)
+            width = field.width
+            height = field.height
         
         ## Create the game world view:
-        self.world = World(Point(width, height), seed=seeds[0])
+        self.world = World(Point(width, height), seed=seeds[0], grid=True)
         # Set seed for static generator:
         random.seed(seeds[1])
         
@@ -128,24 +207,35 @@ class AgentGame:
         
         ## Fill the walls
         if filename != None:
-            self.world.loadField(pxarray)
+            self.world.loadField(field)
         else:
             self.world.generateWalls(walls)
-            # Save a copy of the current field
-            pxarray = pygame.PixelArray(pygame.Surface(self.world.size))
-            self.world.saveField(pxarray)
-            pygame.image.save(pxarray.surface, "currentmap.bmp")
+            if savemap != None:
+                # Save a copy of the current field
+                mapfile.save(savemap, self.world.saveField())
                 
         self.fps = fps      # Frames per second
         self.tilesize = tilesize    # tile size
+        self.threaded = threaded    # simulate in a separate thread (see start)
+        if checks not in CHECKMODES:
+            raise ValueError("Unknown checks mode {!r} (not in {})".format(checks, CHECKMODES))
+        if checkEvery <= 0:
+            raise ValueError("checkEvery must be positive, not {!r}".format(checkEvery))
+        self.checks = checks        # how to check the bodies invariant
+        self.checkEvery = checkEvery
+        self.rounds = 0             # rounds played
+        self.latest = None          # last published Snapshot (if visual)
         
         if visual: 
             #create the window and do other stuff
+            if pygame == None:
+                raise ImportError("pygame is needed to show the game (use no video)")
             pygame.init()
             self.screen = pygame.display.set_mode(((self.world.size.x)*self.tilesize,(self.world.size.y)*self.tilesize+25), pygame.RESIZABLE)
             pygame.display.set_caption('LongLife Cooperating Agents Game')
             #load the font
             self.font = pygame.font.Font(None, 30)
+            self.background = None  # cached Surface with the walls (see show)
         else:
             self.screen = None
             self.fps = 0         # no need to slow down when not displaying
@@ -154,7 +244,7 @@ class AgentGame:
         self.allPlayers = []
         for name in ["P0", "P1"]:
             body = self.world.generatePlayerBody(name)
-            player = Player(name, body, self.world, AgentClass, seed=random.randrange(2**60))
+            player = Player(name, body, self.world, AgentClass, seed=random.randrange(2**60), sandbox=sandbox)
             self.allPlayers.append(player)
         self.livePlayers = self.allPlayers[:]   # list of live players
         self.deadPlayers = []                   # list of dead players
@@ -166,32 +256,22 @@ class AgentGame:
                 self.world.generateFood(t)
                 foodcount += 1
         
-    def calibrationTime(self):
-        """Run a calibration loop and return the time it takes to complete."""
-        mockworld = World(Point(60,40), 20171106)
-        mockworld.generateWalls(15)
-        origin = Point(0,0)
-        p = mockworld.randCoords()
-        a = Stay
-        t = time.process_time()
-        t2 = time.perf_counter()
-        #t3 = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID) # Not on Windows
-        for k in range(10000):
-            p = mockworld.translate(p, a)
-            d = mockworld.dist(p, origin)
-            if p in mockworld.walls:
-                a = mockworld.rnd.choice(ACTIONS[1:])
-            else:
-                mockworld.put(p, 'x')
-        t = time.process_time() - t
-        t2 = time.perf_counter() - t2
-        #t3 = time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID) - t3
-        logging.debug("Calibration(cpu,perf) {:.6f} {:.6f}".format(t, t2))
-        return t
-    
-    def killPlayer(self, player):
+        ## Record the game (to replay it later)
+        self.recorder = Recorder(record, self) if record != None else None
+        
+        ## Time the phases of the game loop (see profiler.py)
+        self.profiler = profiler if profiler != None else NULLPROFILER
+        
+        ## Log the events of each turn (see eventlog.py)
+        self.eventlog = EventLog(eventlog, self) if eventlog != None else None
+        
+    def killPlayer(self, player, cause):
         #for t in player.nutrients:
         #    player.nutrients[t] = 0
+        player.deathCause = cause
+        if self.eventlog != None:
+            self.eventlog.death(player)
+        player.close()
         self.livePlayers.remove(player)
         self.deadPlayers.append(player)
 
@@ -199,14 +279,14 @@ class AgentGame:
         
         ## Check action
         if action not in ACTIONS:
-            self.killPlayer(player)
-            logging.error("{} invalid action: {} -> DEAD".format(player.name, action))
+            self.killPlayer(player, player.failure or "invalid action")
+            logging.error("%s invalid action: %s -> DEAD", player.name, action)
             return
         
         ## Check message
         if not isinstance(player.outbox, bytes):
-            self.killPlayer(player)
-            logging.error("{} invalid message: {} -> DEAD".format(player.name, player.outbox))
+            self.killPlayer(player, "invalid message")
+            logging.error("%s invalid message: %s -> DEAD", player.name, player.outbox)
             player.outbox = b""
             return
         
@@ -218,13 +298,16 @@ class AgentGame:
         player.nutrients['S'] -= costT + costC
         # Acting consumes M nutrients:
         player.nutrients['M'] -= costA
-        logging.info("{} consumes {} units of S <= spent {:.4f} s thinking.".format(player.name, costT, player.timespent))
-        logging.info("{} consumes {} units of S <= spent {} bytes communicating.".format(player.name, costC, len(player.outbox)))
-        logging.info("{} consumes {} units of M <= chose action {}.".format(player.name, costA, action))
+        if logger.isEnabledFor(logging.INFO):
+            logging.info("%s consumes %d units of S <= spent %.4f s thinking.", player.name, costT, player.timespent)
+            logging.info("%s consumes %d units of S <= spent %d bytes communicating.", player.name, costC, len(player.outbox))
+            logging.info("%s consumes %d units of M <= chose action %s.", player.name, costA, action)
+        if self.eventlog != None:
+            self.eventlog.consume(player, costT + costC, costA)
         
         if player.nutrients['S'] <= 0 or player.nutrients['M'] <= 0:
-            self.killPlayer(player)
-            logging.info("{} run out of nutrients -> DEAD".format(player.name))
+            self.killPlayer(player, "nutrients")
+            logging.info("%s run out of nutrients -> DEAD", player.name)
             return
         
         ## Move (or stay put)
@@ -234,32 +317,44 @@ class AgentGame:
             head = self.world.translate(head, action)
                     
             # Check if the player crashed
-            if head in self.world.walls:    # hit a wall
-                self.killPlayer(player)
-                logging.info("{} crashed against wall -> DEAD".format(player.name))
+            cell = self.world.cellType(head)
+            if cell == WALLCELL:    # hit a wall
+                self.killPlayer(player, "wall")
+                logging.info("%s crashed against wall -> DEAD", player.name)
                 return
-            if head in self.world.bodies:   # hit a body
-                self.killPlayer(player)
-                logging.info("{} crashed against a body -> DEAD".format(player.name))
+            if cell == BODYCELL:    # hit a body
+                self.killPlayer(player, "body")
+                logging.info("%s crashed against a body -> DEAD", player.name)
                 return
             # Update the body
             tail = player.body[-1]   # tail tip (may be needed after eating)
-            player.body = [head] + player.body[:-1]
+            player.body = (head,) + player.body[:-1]
             self.world.bodies[head] = player.name
             self.world.bodies.pop(tail)
-            if head in self.world.food: # eat food
+            if self.checks == "incremental":
+                self.checkMove(player, head, tail)
+            if cell == FOODCELL:    # eat food
                 ## remove the food
                 t = self.world.eatFood(head)
-                self.world.generateFood(t)
+                p = self.world.generateFood(t)
+                if self.recorder != None:
+                    self.recorder.foodCreated(p)
+                if self.eventlog != None:
+                    self.eventlog.eat(player, t, p)
                 ## absorb nutrients (but not indefinitely)
                 player.nutrients[t] = min(player.nutrients[t]+100, 2000)
                 ## grow body
-                #player.body.append(tail)
+                #player.body += (tail,)
                 #self.world.bodies[tail] = player.name
-        
-        self.checkBodies()  # check bodies invariant
+
+    def checkMove(self, player, head, tail):
+        """Check the bodies invariant in the cells changed by a move."""
+        assert self.world.bodies.get(head) == player.name, (head, player)
+        assert tail not in self.world.bodies, (tail, player)
+        assert len(self.world.bodies) == sum(len(p.body) for p in self.allPlayers), (self.world.bodies,)
 
     def checkBodies(self):
+        """Check that world.bodies has exactly the cells of all player bodies."""
         c = 0
         for player in self.allPlayers:
             for pos in player.body:
@@ -274,7 +369,7 @@ class AgentGame:
         if self.screen != None:
             self.world.keys = []
             for event in pygame.event.get():
-                if event.type == QUIT or (event.type == pygame.KEYDOWN and event.key == K_ESCAPE): #close window or press ESC
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE): #close window or press ESC
                     pygame.quit();
                     raise KeyboardInterrupt("ESC pressed")
                 elif event.type == pygame.KEYDOWN:
@@ -283,58 +378,108 @@ class AgentGame:
                 elif event.type == pygame.VIDEORESIZE:
                     self.tilesize = int(min(event.w/self.world.size.x, event.h/self.world.size.y))
                     self.screen = pygame.display.set_mode((self.world.size.x*self.tilesize, self.world.size.y*self.tilesize+25), pygame.RESIZABLE)
+                    self.background = None  # redraw everything at the new size
                     print(event, self.tilesize)
     
-    def show(self):
-        # Show all the game contents in the screen
+    def publish(self):
+        """Log the stats and publish a Snapshot of the game state in self.latest
+        (only if visual: otherwise there is nothing to show)."""
+        if self.screen != None or logger.isEnabledFor(logging.INFO):
+            line = "  ".join(str(p) for p in self.allPlayers)
+            logging.info("Stats: %s", line)
+        if len(self.livePlayers) == 0:
+            logging.info("GAME OVER")
+        if self.screen != None:
+            # (a single assignment, so the render loop always sees a whole snapshot)
+            self.latest = Snapshot(tuple(self.world.food.items()),
+                tuple((p.body, p.nutrients['M'], p.nutrients['S']) for p in self.allPlayers),
+                line, len(self.livePlayers) == 0)
+    
+    def show(self, snapshot):
+        # Show a snapshot of the game contents in the screen
+        # The walls never change: they are drawn once, to a cached background
+        # Surface.  In each frame, only the cells that changed since the last
+        # frame are drawn again, and only their rectangles are updated.
         if self.screen != None:
             T = self.tilesize
-            self.screen.fill((0,0,0))
-            
-            # Show walls
-            for wall in self.world.walls:
-                pygame.draw.rect(self.screen, WALLCOLOR, (wall[0]*T, wall[1]*T, T, T), 0)
+            rects = []
+            if self.background == None:
+                self.background = self.drawBackground()
+                self.screen.blit(self.background, (0, 0))
+                self.frame = {}
+                self.statsLine = None
+                rects.append(self.screen.get_rect())
             
-            # Show food
-            for f in self.world.food:
-                pygame.draw.ellipse(self.screen, FOODCOLOR[self.world.food[f]], (f[0]*T, f[1]*T, T, T), 0)
+            # What to draw in each cell: food...
+            frame = {}
+            for f, t in snapshot.food:
+                frame[f] = (pygame.draw.ellipse, FOODCOLOR[t])
             
-            ## Show players
-            for player in self.allPlayers:
-                f = 0.25+0.75*player.nutrients['S']/2000
+            ## ...and players
+            for (body, M, S) in snapshot.players:
+                f = 0.25+0.75*S/2000
                 (r,g,b) = FOODCOLOR['S']
                 head_color = (int(r*f), 64, int(b*f))
-                f = 0.25+0.75*player.nutrients['M']/2000
+                f = 0.25+0.75*M/2000
                 (r,g,b) = FOODCOLOR['M']
                 color = (int(r*f), 64, int(b*f))
                 #head + rest of body
-                pygame.draw.rect(self.screen, head_color, (player.body[0][0]*T, player.body[0][1]*T, T, T), 0)
-                for part in player.body[1:]:
-                    pygame.draw.rect(self.screen, color, (part[0]*T, part[1]*T, T, T), 0)
+                frame[body[0]] = (pygame.draw.rect, head_color)
+                for part in body[1:]:
+                    frame[part] = (pygame.draw.rect, color)
             
-        # Show stats
-        line = "  ".join(str(p) for p in self.allPlayers)
-        
-        logging.info("Stats: "+line)
-        
-        if self.screen != None:
-            ## Show stats
-            text = self.font.render(line, 1, (255,255,255))
-            textpos = text.get_rect(x=0, y=(self.world.size.y)*self.tilesize)
-            self.screen.blit(text, textpos)
-        
-        if len(self.livePlayers) == 0:
-            line = "GAME OVER"
-            logging.info(line)
-            if self.screen != None:
-                text=self.font.render(line, 1, (255,128,0), (0,0,0))
+            # Erase cells that were emptied, draw cells that changed
+            for pos in self.frame.keys() - frame.keys():
+                rect = pygame.Rect(pos[0]*T, pos[1]*T, T, T)
+                self.screen.blit(self.background, rect, rect)
+                rects.append(rect)
+            for pos, cell in frame.items():
+                if self.frame.get(pos) != cell:
+                    (draw, color) = cell
+                    rect = pygame.Rect(pos[0]*T, pos[1]*T, T, T)
+                    self.screen.blit(self.background, rect, rect)
+                    draw(self.screen, color, rect, 0)
+                    rects.append(rect)
+            self.frame = frame
+            
+            ## Show stats (rendered again only when they change)
+            line = snapshot.stats
+            if line != self.statsLine:
+                self.statsLine = line
+                rect = pygame.Rect(0, self.world.size.y*T, self.screen.get_width(), self.screen.get_height() - self.world.size.y*T)
+                self.screen.fill((0,0,0), rect)
+                text = self.font.render(line, 1, (255,255,255))
+                textpos = text.get_rect(x=0, y=(self.world.size.y)*self.tilesize)
+                self.screen.blit(text, textpos)
+                rects.append(rect)
+            
+            if snapshot.gameover:
+                text=self.font.render("GAME OVER", 1, (255,128,0), (0,0,0))
                 textpos = text.get_rect(centerx=self.screen.get_width()/2, centery=self.screen.get_height()/2)
                 self.screen.blit(text, textpos)
+                rects.append(textpos)
+            
+            pygame.display.update(rects)
+    
+    def drawBackground(self):
+        """Return a Surface of the size of the screen with the walls drawn in it."""
+        T = self.tilesize
+        background = pygame.Surface(self.screen.get_size()).convert()
+        background.fill((0,0,0))
+        for wall in self.world.walls:
+            background.fill(WALLCOLOR, (wall[0]*T, wall[1]*T, T, T))
+        return background
     
     def start(self):
-        clock = pygame.time.Clock()
+        """Play the game until all players die, and return the score.
+
+        Normally, each round is played and then shown, at most fps rounds
+        per second.  If threaded (and visual), the rounds are played at full
+        speed in a separate thread, and the screen shows the latest state
+        at fps frames per second.
+        """
         # Single mailbox for passing messages between players:
-        mailbox = b""
+        self.mailbox = b""
         
         # Discriminator for spreading food movement between player turns
         #   DISC = p*m - f*n,
@@ -347,165 +492,169 @@ class AgentGame:
         # Note that:
         #   DISC > 0  <=>  p*m > f*n  <=>  p/n > f/m,
         # which means "number of foods is lower than it should"
-        DISC = 0
+        self.DISC = 0
         
-        ## Main loop
-        while len(self.livePlayers) > 0:
-            clock.tick(self.fps)
-            
-            self.getEvents()
-            
-            #game logic is updated in the code below
-            
-            ## Update players
-            n = len(self.livePlayers)   # number of players (and turns)
-            for player in self.livePlayers:
-                player.age += 1           # lived another tick!
-                
-                ## Move some foods (only this turn's share)
-                assert len(self.world.foodQueue['M']) == self.foodquant
-                DISC += self.foodquant  # another turn, increase m
-                while DISC > 0:
-                    self.world.moveFood('M')
-                    DISC -= len(self.livePlayers)  # another movement, decrease n
-                
-                ## Transfer info to agent
-                player.transferInfo()
-                vision = namedtuple('Vision', ['bodies', 'food'])
-                vision.bodies = player.filterVision(self.world.bodies)
-                vision.food = player.filterVision(self.world.food)
+        if self.screen != None and self.threaded:
+            self.runThreaded()
+        else:
+            clock = pygame.time.Clock() if self.screen != None else None
+            ## Main loop
+            while len(self.livePlayers) > 0:
+                if clock != None:
+                    clock.tick(self.fps)
                 
-                ## Call the AGENT (and measure time and catch errors)
-                timeout = player.nutrients['S']*self.timeslot + 1.0
-                s = time.process_time()
-                try:
-                    setDeadline(s, timeout, time.process_time)
-                    action, player.outbox = player.agent.chooseAction(vision, mailbox)
-                except Exception as e:
-                    action, player.outbox = None, b""  # default if agent fails => Die
-                    logging.exception(e)
-                finally:
-                    unsetDeadline()
-                f = time.process_time()
+                self.getEvents()
                 
-                player.timespent = f - s
-                logging.debug("{}.timespent = {:.4f} s".format(player.name, player.timespent))
-                ## Execute the action and update the game
-                self.executeAction(player, action)
-                # Pass message
-                mailbox = player.outbox
+                #game logic is updated in the code below
+                self.playRound()
                 
-                ## If heads touch, redistribute nutrients
-                # DONE: now done after each player!
-                # DONE: now works for N players!
-                # DONE: now only works on live players!
-                neighbors = [p for p in self.livePlayers if self.world.dist(player.body[0], p.body[0]) <= 1]
-                if len(neighbors) > 1:
-                    logging.info("Rendez-vous {}".format(neighbors))
-                    logging.debug("Before redistribution: {}".format(self.allPlayers))
-                    Player.redistributeNutrients(neighbors)
-                    logging.debug("After redistribution: {}".format(self.allPlayers))
-                    
-            ## Show the game state
-            self.show()
-            
-            if self.screen != None:
-                pygame.display.update()
-
-        while self.screen != None:
-            # Pygame BUG?: This seems to busy-wait (100% CPU)! Why?
-            event = pygame.event.wait()
-            if event.type == QUIT or (event.type == pygame.KEYDOWN and event.key == K_ESCAPE): #close window or press ESC
-                pygame.quit(); 
-                break
+                ## Show the game state
+                t = self.profiler.mark()
+                self.publish()
+                t = self.profiler.lap("publish", t)
+                self.show(self.latest)
+                self.profiler.lap("show", t)
+        
+        if self.recorder != None:
+            self.recorder.close()
+        if self.eventlog != None:
+            self.eventlog.close()
+        
+        self.idle()
         
         score = sum([p.age for p in self.allPlayers])
         return score
-
-
-## The timeout feature. (NOT VERY PORTABLE! May work only on UNIX systems.)
-
-import signal
-import math
-
-def timeoutHandler(signum, frame):
-    """Handler for SIGALRM.
-    Funtion keeps 3 important attributes: .clock, .startTime, .limit."""
-    currTime = timeoutHandler.clock()
-    elapsed = currTime - timeoutHandler.startTime
-    logging.debug("timeoutHandler elapsed={} limit={}.".format(elapsed, timeoutHandler.limit))
-    if elapsed < timeoutHandler.limit:
-        logging.debug("timeoutHandler woke up too early! Reseting alarm.")
-        signal.alarm(int(math.ceil(timeoutHandler.limit - elapsed)))
-    else:
-        logging.debug("timeoutHandler interrupting.")
-        # reset previous handler
-        unsetDeadline()
-        raise TimeoutError("Timeout reached.")
-
-def setDeadline(start, limit, clock):
-    """Set a deadline for after timeout seconds (int>0), measured using clock function."""
-    logging.debug("setDeadline start={} limit={} clock={}.".format(start, limit, clock))
-    ## Set a timeout
-    timeoutHandler.prevHandler = signal.signal(signal.SIGALRM, timeoutHandler)
-    timeoutHandler.startTime = start
-    timeoutHandler.limit = limit
-    timeoutHandler.clock = clock
-    #currTime = timeoutHandler.clock()
-    signal.alarm(int(math.ceil(limit)))
-    return start
-
-def unsetDeadline():
-    """Remove a pending deadline."""
-    signal.alarm(0)
-    signal.signal(signal.SIGALRM, timeoutHandler.prevHandler)
-
-
-## ATTEMPTS at making the timeout feature as a context manager.
-## NOT WORKING YET!
-from contextlib import contextmanager
-
-# NOT WORKING
-@contextmanager
-def timelimit(limit, clock):
-    """Run block subject to a time limit as measured by a given clock function."""
-    try:
-        logging.debug("setDeadline start={} limit={} clock={}.".format(start, limit, clock))
-        ## Set a timeout
-        timeoutHandler.prevHandler = signal.signal(signal.SIGALRM, timeoutHandler)
-        timeoutHandler.startTime = start
-        timeoutHandler.limit = limit
-        timeoutHandler.clock = clock
-        signal.alarm(int(math.ceil(limit)))
-        start = clock()
-        yield start
-    finally:
-        signal.signal(signal.SIGALRM, timeoutHandler.prevHandler)
-        signal.alarm(0)
+    
+    def playRound(self):
+        """Let each live player take a turn."""
+        profiler = self.profiler
+        start = profiler.mark()
+        self.rounds += 1
+        if self.recorder != None:
+            self.recorder.startRound()
         
-
-
-def handler(signum, frame):
-    raise TimeoutError("time limit reached")
-
-# NOT WORKING
-@contextmanager
-def timelimit2(limit, clock):
-    """Run block subject to a time limit as measured by a given clock function."""
-    signal.alarm(0)                                         # cancel any pending alarm
-    prevHandler = signal.signal(signal.SIGALRM, handler)    # register our handler
-    start = clock()
-    logging.debug("timelimit: start={} limit={} clock={}.".format(start, limit, clock))
-    elapsed = 0.0
-    try:
-        logging.debug("timelimit: {}<{}: setting alarm.".format(elapsed, limit))
-        signal.alarm(int(math.ceil(limit - elapsed)))
-        yield start              # execute block
-        limit = elapsed     # concluded within limit => force stop
-    except TimeoutError as e:       # alarm expired (real time)
-        elapsed = clock() - start   # how much time passed in our clock?
-    finally:
-        logging.debug("timelimit: {}<{}: setting alarm.".format(elapsed, limit))
-        signal.alarm(0)
-        signal.signal(signal.SIGALRM, prevHandler)
+        ## Update players
+        n = len(self.livePlayers)   # number of players (and turns)
+        for player in self.livePlayers:
+            t = profiler.mark()
+            player.age += 1           # lived another tick!
+            
+            ## Move some foods (only this turn's share)
+            assert len(self.world.foodQueue['M']) == self.foodquant
+            self.DISC += self.foodquant  # another turn, increase m
+            while self.DISC > 0:
+                moved = self.world.moveFood('M')
+                if self.recorder != None:
+                    self.recorder.foodMoved(*moved)
+                if self.eventlog != None:
+                    self.eventlog.foodMoved(*moved)
+                self.DISC -= len(self.livePlayers)  # another movement, decrease n
+            t = profiler.lap("moveFood", t)
+            
+            ## Transfer info to agent
+            player.transferInfo()
+            t = profiler.lap("transferInfo", t)
+            vision = player.vision()
+            t = profiler.lap("vision", t)
+            
+            ## Call the AGENT (and measure time and catch errors)
+            # The agent may think until it has spent all its S nutrients.
+            timeout = player.nutrients['S']*self.timeslot
+            limit = player.timeLimit(timeout)
+            try:
+                with limit:
+                    action, player.outbox = player.agent.chooseAction(vision, self.mailbox)
+            except Exception as e:
+                action, player.outbox = None, b""  # default if agent fails => Die
+                player.failure = "timeout" if isinstance(e, TimeoutError) else "exception"
+                logging.exception(e)
+            
+            player.timespent = limit.elapsed
+            logging.debug("%s.timespent = %.4f s", player.name, player.timespent)
+            if self.eventlog != None:
+                self.eventlog.turn(player, action)
+            t = profiler.lap("agent", t)
+            ## Execute the action and update the game
+            self.executeAction(player, action)
+            # Pass message
+            self.mailbox = player.outbox
+            t = profiler.lap("executeAction", t)
+            if self.checks == "full":
+                self.checkBodies()  # check bodies invariant
+                t = profiler.lap("checkBodies", t)
+            
+            ## If heads touch, redistribute nutrients
+            # DONE: now done after each player!
+            # DONE: now works for N players!
+            # DONE: now only works on live players!
+            neighbors = [p for p in self.livePlayers if self.world.dist(player.body[0], p.body[0]) <= 1]
+            if len(neighbors) > 1:
+                logging.info("Rendez-vous %s", neighbors)
+                logging.debug("Before redistribution: %s", self.allPlayers)
+                Player.redistributeNutrients(neighbors)
+                logging.debug("After redistribution: %s", self.allPlayers)
+                if self.eventlog != None:
+                    self.eventlog.rendezvous(player, neighbors)
+            t = profiler.lap("rendezvous", t)
+            
+            if self.recorder != None:
+                self.recorder.endTurn(player, action)
+                profiler.lap("record", t)
         
+        if self.checks == "sampled" and self.rounds % self.checkEvery == 0:
+            t = profiler.mark()
+            self.checkBodies()  # check bodies invariant
+            profiler.lap("checkBodies", t)
+        profiler.lap("round", start)
+    
+    def runThreaded(self):
+        """Play rounds in a simulation thread while this (main) thread
+        shows the latest published snapshot, at most fps times per second.
+        """
+        self.latest = None
+        self.error = None
+        self.stopping = threading.Event()
+        simulation = threading.Thread(target=self.simulate, name="Simulation", daemon=True)
+        simulation.start()
+        clock = pygame.time.Clock()
+        try:
+            while simulation.is_alive():
+                clock.tick(self.fps)
+                self.getEvents()
+                if self.latest != None:
+                    t = self.profiler.mark()
+                    self.show(self.latest)
+                    self.profiler.lap("show", t)
+        finally:
+            # On ESC, let the simulation finish the current round and stop
+            self.stopping.set()
+            simulation.join()
+        if self.error != None:
+            raise self.error
+        self.show(self.latest)      # final state
+    
+    def simulate(self):
+        """Main loop of the simulation thread (see runThreaded)."""
+        try:
+            while len(self.livePlayers) > 0 and not self.stopping.is_set():
+                self.playRound()
+                t = self.profiler.mark()
+                self.publish()
+                self.profiler.lap("publish", t)
+        except Exception as e:
+            self.error = e
+    
+    def idle(self):
+        """Keep showing the final state until the window is closed."""
+        # pygame.event.wait() busy-waits (100% CPU) in some pygame versions,
+        # so poll for events a few times per second instead.
+        if self.screen != None:
+            clock = pygame.time.Clock()
+        while self.screen != None:
+            try:
+                self.getEvents()
+            except KeyboardInterrupt:   # window closed
+                break
+            if self.background == None:     # window resized
+                self.show(self.latest)
+            clock.tick(IDLEFPS)
@@ -0,0 +1,204 @@
+# Persistent on-disk cache of precomputed data about static maps.
+#
+# Agents that analyse the walls of their world (dead ends, corridors,
+# distance tables...) may store the results here and load them in the next
+# games played on the same map, instead of computing them again:
+#
+#     data = mapcache.cached(world, "myagent-1", compute)
+#
+# where compute() returns a dict of {name: array}.  The key of a map is a
+# hash of World.size and World.walls, so it does not depend on the map file.
+# The kind ("myagent-1") should change whenever the computed data changes.
+#
+# Each entry is a small binary file (HEADER + named arrays) in the cache
+# directory, which is $LONGLIFECACHE or ~/.cache/longlife by default.
+# When the directory grows above maxbytes, the least recently used entries
+# are deleted.
+
+from array import array
+import hashlib
+import logging
+import struct
+import zlib
+import sys
+import os
+
+# File format version (entries with other versions are ignored):
+VERSION = 1
+MAGIC = b"LLMC"
+# magic, version, width, height, crc32 of the rest of the file
+HEADER = struct.Struct('<4sHHHI')
+# length of name, typecode, number of items
+SECTION = struct.Struct('<BcI')
+SUFFIX = ".llc"
+
+DEFAULTDIR = os.path.join(os.path.expanduser("~"), ".cache", "longlife")
+DEFAULTMAXBYTES = 64*1024*1024
+
+
+def mapKey(world):
+    """Hash of the size and walls of a world (a hex string)."""
+    (W, H) = world.size
+    cells = bytearray(W*H)
+    for p in world.walls:
+        cells[world.index(p)] = 1
+    h = hashlib.sha1(struct.pack('<II', W, H))
+    h.update(cells)
+    return h.hexdigest()
+
+
+class MapCache:
+    """A directory of cached map data, bounded in size."""
+
+    def __init__(self, directory=None, maxbytes=DEFAULTMAXBYTES):
+        self.directory = directory or os.environ.get("LONGLIFECACHE", DEFAULTDIR)
+        self.maxbytes = maxbytes
+
+    def filename(self, world, kind):
+        return os.path.join(self.directory, "{}-{}{}".format(mapKey(world), kind, SUFFIX))
+
+    def load(self, world, kind):
+        """Return the dict of arrays stored for world and kind, or None."""
+        filename = self.filename(world, kind)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            os.utime(filename)      # mark as recently used
+        except OSError:
+            return None
+        try:
+            return decode(data, world.size)
+        except ValueError as e:
+            logging.warning("Ignoring cache entry {}: {}".format(filename, e))
+            return None
+
+    def store(self, world, kind, arrays):
+        """Store a dict of arrays for world and kind.  Failures are not fatal."""
+        filename = self.filename(world, kind)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmpname = "{}.{}.tmp".format(filename, os.getpid())
+            with open(tmpname, "wb") as f:
+                f.write(encode(arrays, world.size))
+            os.replace(tmpname, filename)   # atomic, even with concurrent games
+            self.evict()
+        except OSError as e:
+            logging.warning("Could not write cache entry {}: {}".format(filename, e))
+
+    def evict(self):
+        """Delete the least recently used entries while above maxbytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:     # deleted meanwhile
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+
+def encode(arrays, size):
+    """Encode a dict of {name: array} as bytes."""
+    parts = []
+    for name, a in sorted(arrays.items()):
+        if sys.byteorder == "big":
+            a = array(a.typecode, a)
+            a.byteswap()
+        name = name.encode()
+        parts.append(SECTION.pack(len(name), a.typecode.encode(), len(a)))
+        parts.append(name)
+        parts.append(a.tobytes())
+    body = b"".join(parts)
+    return HEADER.pack(MAGIC, VERSION, size[0], size[1], zlib.crc32(body)) + body
+
+def decode(data, size):
+    """Decode bytes produced by encode.  Raises ValueError if invalid."""
+    if len(data) < HEADER.size:
+        raise ValueError("truncated")
+    (magic, version, W, H, crc) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("unknown format")
+    if (W, H) != tuple(size):
+        raise ValueError("wrong size")
+    body = memoryview(data)[HEADER.size:]
+    if zlib.crc32(body) != crc:
+        raise ValueError("corrupted")
+    arrays = {}
+    k = 0
+    while k < len(body):
+        (n, typecode, length) = SECTION.unpack_from(body, k)
+        k += SECTION.size
+        name = bytes(body[k:k+n]).decode()
+        k += n
+        a = array(typecode.decode())
+        a.frombytes(body[k:k+length*a.itemsize])
+        k += length*a.itemsize
+        if sys.byteorder == "big":
+            a.byteswap()
+        arrays[name] = a
+    return arrays
+
+
+defaultCache = None
+
+def cached(world, kind, compute):
+    """Return the data for world and kind from the default cache,
+    or compute() it (a dict of {name: array}) and store it there."""
+    global defaultCache
+    if defaultCache is None:
+        defaultCache = MapCache()
+    arrays = defaultCache.load(world, kind)
+    if arrays is None:
+        arrays = compute()
+        defaultCache.store(world, kind, arrays)
+    return arrays
+
+
+## TESTS
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+    from world import *
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = MapCache(tmp, maxbytes=2000)
+        w = World(Point(60,40), seed=1)
+        w.generateWalls(15)
+        data = {'cells': array('I', range(100)), 'flags': array('B', [1,0,1])}
+        assert cache.load(w, "test") is None
+        cache.store(w, "test", data)
+        assert cache.load(w, "test") == data
+
+        # Same walls, other world => same entry; other walls => other entry
+        w2 = World(Point(60,40), seed=2)
+        w2.walls.update(w.walls)
+        assert cache.load(w2, "test") == data
+        w2.walls[w2.randCoords()] = WALL
+        assert cache.load(w2, "test") is None
+
+        # Corrupted entries are ignored
+        with open(cache.filename(w, "test"), "r+b") as f:
+            f.seek(HEADER.size+2)
+            f.write(b"\xFF")
+        assert cache.load(w, "test") is None
+
+        # Least recently used entries are evicted (each entry is ~420 bytes)
+        for k in range(8):
+            cache.store(w, "kind{}".format(k), data)
+            time.sleep(0.01)
+        names = os.listdir(tmp)
+        assert len(names) == 4, names
+        assert cache.load(w, "kind0") is None and cache.load(w, "kind7") == data
+    print("OK")
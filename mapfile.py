@@ -0,0 +1,251 @@
+# Map files: the walls, foodfield and playerfield of a world, as an image.
+#
+# Each pixel of a map is a cell, with one of the colours (as RGB):
+#   FFFFFF empty,  AA7942 wall,  00F900 foodfield,  FF2600 playerfield.
+# A map is read into a Field, whose .cells are the bytes of the code of
+# each cell (EMPTY, WALL, FOOD, PLAYER or UNKNOWN), indexed by x + y*width
+# like World.grid:
+#
+#     field = mapfile.load("maps/mapa1.bmp")
+#     world = World(Point(field.width, field.height), grid=True)
+#     world.loadField(field)
+#     ...
+#     mapfile.save("currentmap.bmp", world.saveField())
+#
+# Uncompressed BMP files (24 or 32 bits per pixel, or 8 bits with a
+# palette) are read and written here, without pygame.  The colours are
+# classified with whole-image bytes operations instead of pixel by pixel:
+# the green channel alone tells the four colours apart, so one translate
+# gives the codes, and the red and blue channels are then checked against
+# the colours of those codes.  Other image formats are loaded with pygame.
+#
+# Loaded Fields are kept in memory (by file name, size and modification
+# time), so playing many games on a map reads it only once.
+
+from collections import namedtuple
+import logging
+import struct
+import os
+
+# Cell codes:
+EMPTY = 0
+WALL = 1
+FOOD = 2
+PLAYER = 3
+UNKNOWN = 4     # (treated as empty)
+
+COLORS = {EMPTY: 0xFFFFFF, WALL: 0xAA7942, FOOD: 0x00F900, PLAYER: 0xFF2600}
+
+
+def channelTable(shift):
+    """Table for bytes.translate: cell code -> channel of its colour (white if none)."""
+    table = bytearray(b"\xFF"*256)
+    for code, color in COLORS.items():
+        table[code] = (color >> shift) & 0xFF
+    return bytes(table)
+
+# Tables for bytes.translate: green channel -> code, and code -> channel
+GREENCODE = bytearray([UNKNOWN]*256)
+for code, color in COLORS.items():
+    GREENCODE[(color >> 8) & 0xFF] = code
+GREENCODE = bytes(GREENCODE)
+RED = channelTable(16)
+GREEN = channelTable(8)
+BLUE = channelTable(0)
+
+def mask(code):
+    """Table for bytes.translate: cell code -> 1 if it is code, 0 otherwise."""
+    return bytes(1 if c == code else 0 for c in range(256))
+
+
+# BMP file header: magic, file size, reserved, offset of the pixels
+FILEHEADER = struct.Struct('<2sIHHI')
+# BITMAPINFOHEADER: size, width, height, planes, bits per pixel, compression,
+# size of the pixels, horizontal and vertical resolution, colours, important colours
+INFOHEADER = struct.Struct('<IiiHHIIiiII')
+BI_RGB = 0
+BI_BITFIELDS = 3
+
+# Number of Fields kept in memory by load:
+MAXLOADED = 16
+
+
+class Field(namedtuple("Field", ['width', 'height', 'cells'])):
+    """The cells of a map: bytes of cell codes, indexed by x + y*width."""
+
+    __slots__ = ()
+
+
+def classify(width, height, red, green, blue):
+    """Field from the colour channels of an image (bytes, one per pixel,
+    row by row from the top)."""
+    cells = green.translate(GREENCODE)
+    if UNKNOWN in cells or cells.translate(RED) != red or cells.translate(BLUE) != blue:
+        # Some pixels have other colours: find them
+        cells = bytearray(cells)
+        known = {color: code for code, color in COLORS.items()}
+        for i in range(width*height):
+            color = red[i] << 16 | green[i] << 8 | blue[i]
+            cells[i] = known.get(color, UNKNOWN)
+            if cells[i] == UNKNOWN:
+                logging.error("UNKNOWN color: %02X", color)
+        cells = bytes(cells)
+    return Field(width, height, cells)
+
+
+def decode(data):
+    """Field from the bytes of a BMP file.  Raises ValueError if not supported."""
+    if len(data) < FILEHEADER.size + INFOHEADER.size:
+        raise ValueError("truncated")
+    (magic, _, _, _, offset) = FILEHEADER.unpack_from(data)
+    (headersize, width, height, planes, bpp, compression, _, _, _, ncolors, _) = \
+        INFOHEADER.unpack_from(data, FILEHEADER.size)
+    if magic != b"BM" or headersize < INFOHEADER.size:
+        raise ValueError("not a Windows BMP file")
+    if bpp not in (8, 24, 32) or not (compression == BI_RGB or compression == BI_BITFIELDS and bpp == 32):
+        raise ValueError("unsupported BMP: {} bits per pixel, compression {}".format(bpp, compression))
+    if compression == BI_BITFIELDS:
+        masks = struct.unpack_from('<III', data, FILEHEADER.size + INFOHEADER.size)
+        if masks != (0xFF0000, 0xFF00, 0xFF):
+            raise ValueError("unsupported BMP bit fields: {}".format(masks))
+    topdown = height < 0
+    height = abs(height)
+    # Rows of pixels (padded to 4 bytes in the file), from the top
+    stride = (width*bpp + 31)//32*4
+    rowsize = width*bpp//8
+    if offset + stride*height > len(data):
+        raise ValueError("truncated")
+    rows = [data[offset + y*stride : offset + y*stride + rowsize] for y in range(height)]
+    if not topdown:
+        rows.reverse()
+    pixels = b"".join(rows)
+    if bpp == 8:
+        # Palette of BGRx entries: translate indices to channels
+        start = FILEHEADER.size + headersize
+        palette = data[start : start + 4*(ncolors or 256)].ljust(4*256, b"\0")
+        return classify(width, height, pixels.translate(palette[2::4]),
+                        pixels.translate(palette[1::4]), pixels.translate(palette[0::4]))
+    n = bpp//8
+    return classify(width, height, pixels[2::n], pixels[1::n], pixels[0::n])
+
+
+def encode(field):
+    """Bytes of a 24-bit BMP file of a Field."""
+    (W, H, cells) = field
+    pixels = bytearray(3*W*H)
+    pixels[0::3] = cells.translate(BLUE)
+    pixels[1::3] = cells.translate(GREEN)
+    pixels[2::3] = cells.translate(RED)
+    rowsize = 3*W
+    pad = bytes(-rowsize % 4)
+    body = b"".join(pixels[y*rowsize:(y+1)*rowsize] + pad for y in reversed(range(H)))
+    offset = FILEHEADER.size + INFOHEADER.size
+    return (FILEHEADER.pack(b"BM", offset + len(body), 0, 0, offset) +
+            INFOHEADER.pack(INFOHEADER.size, W, H, 1, 24, BI_RGB, len(body), 0, 0, 0, 0) + body)
+
+
+def fromSurface(surface):
+    """Field from a pygame Surface."""
+    import pygame
+    rgb = pygame.image.tostring(surface, "RGB")
+    (width, height) = surface.get_size()
+    return classify(width, height, rgb[0::3], rgb[1::3], rgb[2::3])
+
+
+def fromPixelArray(pxarray):
+    """Field from a pygame PixelArray (as used by older versions)."""
+    return fromSurface(pxarray.surface)
+
+
+loaded = {}     # (file name, size, mtime) -> Field
+
+def load(filename):
+    """Field of a map file (BMP, or any image format pygame reads)."""
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    field = loaded.get(key)
+    if field is None:
+        with open(filename, "rb") as f:
+            data = f.read()
+        try:
+            field = decode(data)
+        except ValueError as e:
+            logging.debug("Loading %s with pygame: %s", filename, e)
+            import pygame
+            field = fromSurface(pygame.image.load(filename))
+        if len(loaded) >= MAXLOADED:
+            del loaded[next(iter(loaded))]
+        loaded[key] = field
+    return field
+
+def save(filename, field):
+    """Write a Field to a BMP file."""
+    with open(filename, "wb") as f:
+        f.write(encode(field))
+
+
+## TESTS (and benchmark)
+
+if __name__ == "__main__":
+    import tempfile
+    import random
+    import time
+    import glob
+
+    rnd = random.Random(1)
+    # All the maps are read as pygame reads them
+    try:
+        import pygame
+    except ImportError:
+        pygame = None
+    for filename in sorted(glob.glob("maps/*.bmp")):
+        field = load(filename)
+        assert load(filename) is field
+        assert field.width*field.height == len(field.cells)
+        if pygame != None:
+            assert fromSurface(pygame.image.load(filename)) == field, filename
+        assert decode(encode(field)).cells == field.cells.replace(bytes([UNKNOWN]), bytes([EMPTY]))
+        print("{}: {}x{}, {} walls, {} unknown".format(filename, field.width, field.height,
+            field.cells.count(WALL), field.cells.count(UNKNOWN)))
+
+    # Other formats and colours
+    with tempfile.TemporaryDirectory() as tmp:
+        field = Field(7, 3, bytes(rnd.choice([EMPTY, WALL, FOOD, PLAYER]) for _ in range(21)))
+        data = encode(field)
+        assert len(data) == 54 + 3*(7*3 + 3)
+        filename = os.path.join(tmp, "test.bmp")
+        save(filename, field)
+        assert load(filename) == field
+        # 32 bits per pixel, top-down rows; and 8 bits with a palette
+        pixels = b"".join(bytes([BLUE[c], GREEN[c], RED[c], 0xFF]) for c in field.cells)
+        data32 = (FILEHEADER.pack(b"BM", 54 + len(pixels), 0, 0, 54) +
+                  INFOHEADER.pack(40, 7, -3, 1, 32, BI_RGB, len(pixels), 0, 0, 0, 0) + pixels)
+        assert decode(data32) == field
+        palette = b"".join(bytes([BLUE[c], GREEN[c], RED[c], 0]) for c in range(4))
+        rows = b"".join(field.cells[y*7:(y+1)*7] + b"\0" for y in reversed(range(3)))
+        data8 = (FILEHEADER.pack(b"BM", 54 + 16 + len(rows), 0, 0, 54 + 16) +
+                 INFOHEADER.pack(40, 7, 3, 1, 8, BI_RGB, len(rows), 0, 0, 4, 0) + palette + rows)
+        assert decode(data8) == field
+        if pygame != None:
+            surface = pygame.image.load(filename)
+            assert fromSurface(surface) == field
+            # Other image formats are loaded with pygame
+            name = os.path.join(tmp, "test.png")
+            pygame.image.save(surface, name)
+            assert load(name) == field
+        # Unknown colours are found (and treated as empty)
+        odd = bytearray(data)
+        odd[54] = 0x12  # blue of the bottom-left pixel
+        assert decode(bytes(odd)).cells == field.cells[:14] + bytes([UNKNOWN]) + field.cells[15:]
+
+    # Benchmark: a large map
+    W = H = 1000
+    field = Field(W, H, bytes(rnd.choice([EMPTY]*8 + [WALL, FOOD]) for _ in range(W*H)))
+    t = time.perf_counter()
+    data = encode(field)
+    t1 = time.perf_counter() - t
+    t = time.perf_counter()
+    assert decode(data) == field
+    t2 = time.perf_counter() - t
+    print("{}x{} map: encode {:.1f} ms, decode {:.1f} ms".format(W, H, t1*1000, t2*1000))
+    print("OK")
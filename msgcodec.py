@@ -0,0 +1,290 @@
+# Compact binary messages between agents.
+#
+# Each byte sent costs S nutrients (see AgentGame.executeAction), and
+# pickle needs dozens of bytes for a Point and a flag.  A Codec packs the
+# fields of registered message schemas into bits instead:
+#
+#     codec = Codec(world)
+#     codec.register("deadlock", [("pos", POINT), ("taken", FLAG)])
+#     data = codec.encode("deadlock", pos, True)    # 2 bytes on a 60x40 world
+#     ...
+#     (name, msg) = codec.decode(data)              # "deadlock", (pos, taken)
+#
+# A message is the index of its schema (in as few bits as the registry
+# needs) followed by its fields.  Field kinds:
+#   FLAG      1 bit
+#   POINT     the cell index, in just enough bits for the world size
+#   UInt(n)   unsigned int in n bits;  Int(n): signed (two's complement)
+#   VARINT    signed int of any size, in groups of 4 bits plus a
+#             continuation bit (small values are cheaper)
+# With delta=True, a schema sends only the fields that changed since the
+# last message of that schema, after a bit mask of the changed fields.
+# (Both agents must then see every message: the codec keeps the last one
+# sent and the last one received.)
+#
+# Values are checked to fit in their fields (ValueError otherwise).
+# Both agents must register the same schemas in the same order.
+# The empty message (b"") is never produced: it still means "no message".
+
+from collections import namedtuple
+
+
+def toBytes(bits, nbits):
+    """Bytes of the nbits lowest bits of int bits (most significant first),
+    padded with zeros to whole bytes (at least one)."""
+    n = max((nbits + 7)//8, 1)
+    return (bits << (8*n - nbits)).to_bytes(n, 'big')
+
+
+class BitReader:
+    """Reads values of given bit lengths from bytes made by toBytes."""
+
+    def __init__(self, data):
+        self.acc = int.from_bytes(data, 'big')
+        self.left = 8*len(data)     # bits not read yet
+
+    def read(self, nbits):
+        self.left -= nbits
+        if self.left < 0:
+            raise ValueError("message too short")
+        return (self.acc >> self.left) & ((1 << nbits) - 1)
+
+
+## Field kinds
+# pack(value, codec) returns (bits, number of bits) for a value;
+# read(reader, codec) reads a value.
+
+class Flag:
+    def pack(self, value, codec):
+        return (1 if value else 0, 1)
+
+    def read(self, reader, codec):
+        return reader.read(1) == 1
+
+
+class UInt:
+    def __init__(self, nbits):
+        self.nbits = nbits
+
+    def pack(self, value, codec):
+        if not 0 <= value < (1 << self.nbits):
+            raise ValueError("{} does not fit in {} bits".format(value, self.nbits))
+        return (value, self.nbits)
+
+    def read(self, reader, codec):
+        return reader.read(self.nbits)
+
+
+class Int(UInt):
+    def pack(self, value, codec):
+        half = 1 << (self.nbits - 1)
+        if not -half <= value < half:
+            raise ValueError("{} does not fit in {} bits".format(value, self.nbits))
+        return (value & ((1 << self.nbits) - 1), self.nbits)
+
+    def read(self, reader, codec):
+        value = reader.read(self.nbits)
+        return value - (1 << self.nbits) if value >> (self.nbits - 1) else value
+
+
+class VarInt:
+    GROUP = 4   # bits per group
+
+    def pack(self, value, codec):
+        value = 2*value if value >= 0 else -2*value - 1     # zigzag: small magnitudes first
+        G = self.GROUP
+        bits = 0
+        nbits = 0
+        while value >> G:
+            bits = bits << (G + 1) | 1 << G | value & ((1 << G) - 1)
+            nbits += G + 1
+            value >>= G
+        return (bits << (G + 1) | value, nbits + G + 1)
+
+    def read(self, reader, codec):
+        G = self.GROUP
+        value = 0
+        shift = 0
+        while True:
+            group = reader.read(G + 1)
+            value |= (group & ((1 << G) - 1)) << shift
+            shift += G
+            if not group >> G:
+                break
+        return value >> 1 if value & 1 == 0 else -(value >> 1) - 1
+
+
+class PointField:
+    def pack(self, value, codec):
+        return (codec.world.index(value), codec.pointBits)
+
+    def read(self, reader, codec):
+        i = reader.read(codec.pointBits)
+        if i >= codec.cells:
+            raise ValueError("cell index out of range: {}".format(i))
+        return codec.world.cellPoint(i)
+
+
+def pointBits(world):
+    """Number of bits of a cell index in world."""
+    return (world.size.x*world.size.y - 1).bit_length()
+
+
+FLAG = Flag()
+POINT = PointField()
+VARINT = VarInt()
+
+
+class Schema:
+    """A registered kind of message."""
+
+    def __init__(self, name, code, fields, delta=False):
+        self.name = name
+        self.code = code
+        self.names = [f for (f, kind) in fields]
+        self.kinds = [kind for (f, kind) in fields]
+        self.message = namedtuple(name, self.names)
+        self.delta = delta
+        self.sent = None        # last message sent (if delta)
+        self.received = None    # last message received (if delta)
+
+
+class Codec:
+    """A registry of message schemas, to encode and decode messages."""
+
+    def __init__(self, world):
+        self.world = world
+        self.cells = world.size.x*world.size.y
+        self.pointBits = pointBits(world)
+        self.schemas = []
+        self.byName = {}
+        self.codeBits = 0
+
+    def register(self, name, fields, delta=False):
+        """Register a schema: fields is a list of (name, kind) pairs."""
+        if name in self.byName:
+            raise ValueError("schema {} already registered".format(name))
+        schema = Schema(name, len(self.schemas), fields, delta)
+        self.schemas.append(schema)
+        self.byName[name] = schema
+        self.codeBits = (len(self.schemas) - 1).bit_length()
+        return schema
+
+    def encode(self, name, *values, **fields):
+        """Bytes of a message of schema name (values given in order or by name)."""
+        schema = self.byName[name]
+        msg = schema.message(*values, **fields) if fields else values
+        if len(msg) != len(schema.kinds):
+            raise TypeError("{} takes {} fields".format(name, len(schema.kinds)))
+        bits = schema.code
+        nbits = self.codeBits
+        if schema.delta:
+            last = schema.sent
+            changed = [last is None or v != l for v, l in zip(msg, last or msg)]
+            for c in changed:
+                bits = bits << 1 | c
+            nbits += len(changed)
+            for kind, value, c in zip(schema.kinds, msg, changed):
+                if c:
+                    (b, n) = kind.pack(value, self)
+                    bits = bits << n | b
+                    nbits += n
+            schema.sent = msg
+        else:
+            for kind, value in zip(schema.kinds, msg):
+                (b, n) = kind.pack(value, self)
+                bits = bits << n | b
+                nbits += n
+        return toBytes(bits, nbits)
+
+    def decode(self, data):
+        """Return (schema name, message) for bytes produced by encode.
+        Raises ValueError if the message is invalid."""
+        reader = BitReader(data)
+        code = reader.read(self.codeBits)
+        if code >= len(self.schemas):
+            raise ValueError("unknown schema {}".format(code))
+        schema = self.schemas[code]
+        if schema.delta:
+            changed = [reader.read(1) for _ in schema.kinds]
+            last = schema.received
+            if last is None and not all(changed):
+                raise ValueError("delta message of {} without a previous one".format(schema.name))
+            msg = schema.message._make(kind.read(reader, self) if c else l
+                                   for kind, c, l in zip(schema.kinds, changed, last or changed))
+            schema.received = msg
+        else:
+            msg = schema.message._make([kind.read(reader, self) for kind in schema.kinds])
+        return (schema.name, msg)
+
+
+## TESTS
+
+if __name__ == "__main__":
+    import pickle
+    import random
+    import time
+    from world import *
+
+    world = World(Point(60,40))
+    sender = Codec(world)
+    receiver = Codec(world)
+    for codec in (sender, receiver):
+        codec.register("deadlock", [("pos", POINT), ("taken", FLAG)])
+        codec.register("numbers", [("u", UInt(5)), ("i", Int(6)), ("v", VARINT)])
+        codec.register("status", [("head", POINT), ("M", UInt(11)), ("S", UInt(11)), ("target", POINT)], delta=True)
+
+    # Round trips
+    rnd = random.Random(1)
+    for _ in range(1000):
+        p = Point(rnd.randrange(60), rnd.randrange(40))
+        msg = ("deadlock", (p, rnd.random() < 0.5))
+        data = sender.encode(msg[0], *msg[1])
+        assert receiver.decode(data) == msg and len(data) == 2
+        values = (rnd.randrange(32), rnd.randrange(-32, 32), rnd.randrange(-10**6, 10**6))
+        assert receiver.decode(sender.encode("numbers", *values)) == ("numbers", values)
+    for v in (0, 1, -1, 7, -8, 8, 2**40, -2**40):
+        assert receiver.decode(sender.encode("numbers", 0, 0, v))[1].v == v
+    assert sender.encode("deadlock", Point(61,-1), True) == sender.encode("deadlock", Point(1,39), True)
+    for bad in ((32, 0, 0), (0, 32, 0), (0, -33, 0)):
+        try:
+            sender.encode("numbers", *bad)
+            assert False, bad
+        except ValueError:
+            pass
+    for (bad, error) in ((b"\x3F\xFE", "cell index out of range"),   # deadlock at cell index 4095
+                         (b"\xFF\xFF", "unknown schema")):            # schema 3 (not registered)
+        try:
+            receiver.decode(bad)
+            assert False, bad
+        except ValueError as e:
+            assert str(e).startswith(error), e
+
+    # Delta encoding: unchanged fields are not sent
+    status = [Point(10,10), 1000, 1000, Point(20,30)]
+    sizes = []
+    for k in range(50):
+        status[0] = world.translate(status[0], rnd.choice(DIRECTIONS))
+        status[1 + k%2] -= 1
+        if k % 10 == 0:
+            status[3] = Point(rnd.randrange(60), rnd.randrange(40))
+        data = sender.encode("status", *status)
+        sizes.append(len(data))
+        assert receiver.decode(data) == ("status", tuple(status))
+    print("status: first {} bytes, then mean {:.2f} bytes (plain: 6)".format(sizes[0], sum(sizes[1:])/len(sizes[1:])))
+
+    # Size and speed against pickle
+    p = Point(37, 21)
+    print("deadlock: pickle {} bytes, codec {} bytes".format(
+        len(pickle.dumps((p, True))), len(sender.encode("deadlock", p, True))))
+    N = 20000
+    t = time.perf_counter()
+    for _ in range(N):
+        receiver.decode(sender.encode("deadlock", p, True))
+    t1 = time.perf_counter() - t
+    t = time.perf_counter()
+    for _ in range(N):
+        pickle.loads(pickle.dumps((p, True)))
+    t2 = time.perf_counter() - t
+    print("round trip: codec {:.2f} us, pickle {:.2f} us".format(t1/N*1e6, t2/N*1e6))
+    print("OK")
@@ -0,0 +1,592 @@
+# Path finding on the map of a World.
+#
+# A Grid holds the passability of every cell in a flat bytearray (indexed
+# like World.grid, i = x + y*width) and uses the World's neighbour table,
+# so the searches work on integer cell indices and do not create Points.
+# Every search takes the start and goal as Points, plus optional obstacles
+# (e.g. vision.bodies) that are blocked only for that search, and returns
+# a path as a list of Points, from the first step to the goal
+# (an empty list if there is no path, or if start == goal).
+# A path that later becomes blocked (e.g. by bodies that moved) can be fixed
+# with repair, which only searches a detour around the blocked stretch.
+#
+# Run this module as a script to benchmark the searches:
+#   python3 pathfinding.py maps/mapa1.bmp maps/mapa2.bmp
+
+from collections import deque, OrderedDict
+from array import array
+import heapq
+
+from world import *
+
+# Distance stored for unreachable cells in distance tables:
+UNREACHABLE = 0xFFFF
+
+
+class Grid:
+    """Passability of the cells of a world, for path finding.
+
+    Walls are never passable; blocked is an optional collection of other
+    positions that should be avoided (e.g. dead ends).
+    """
+
+    def __init__(self, world, blocked=()):
+        self.world = world
+        self.size = world.size
+        (W, H) = world.size
+        self.passable = bytearray(b"\x01")*(W*H)
+        for p in world.walls:
+            self.passable[world.index(p)] = 0
+        for p in blocked:
+            self.passable[world.index(p)] = 0
+        self.neighbours = world.neighbours[1:]  # only DIRECTIONS (no Stay)
+        # Coords of each cell, for heuristics:
+        self.xs = array('i', [i%W for i in range(W*H)])
+        self.ys = array('i', [i//W for i in range(W*H)])
+
+    def index(self, p):
+        return self.world.index(p)
+
+    def point(self, i):
+        return self.world.cellPoint(i)
+
+    def isPassable(self, p):
+        return self.passable[self.world.index(p)] == 1
+
+    def indices(self, positions):
+        """Set of the cell indices of positions."""
+        index = self.world.index
+        return {index(p) for p in positions}
+
+    def heuristic(self, goal):
+        """Return a function giving the toroidal Manhattan distance from a cell index to goal."""
+        xdist = self.world.xdist
+        ydist = self.world.ydist
+        xs = self.xs
+        ys = self.ys
+        (gx, gy) = (goal%self.size.x, goal//self.size.x)
+        return lambda i: xdist[xs[i]-gx] + ydist[ys[i]-gy]
+
+    def path(self, cameFrom, start, goal):
+        """Reconstruct the path from start to goal as a list of Points (start excluded)."""
+        path = []
+        i = goal
+        while i != start:
+            path.append(self.point(i))
+            i = cameFrom[i]
+        path.reverse()
+        return path
+
+
+def bfs(grid, start, goal, obstacles=(), maxnodes=None):
+    """Breadth-first search: a shortest path from start to goal."""
+    (s, g) = (grid.index(start), grid.index(goal))
+    blocked = grid.indices(obstacles)
+    if s == g or not grid.passable[g] or g in blocked:
+        return []
+    passable = grid.passable
+    neighbours = grid.neighbours
+    cameFrom = {s: s}
+    queue = deque([s])
+    expanded = 0
+    while queue:
+        i = queue.popleft()
+        expanded += 1
+        if maxnodes is not None and expanded > maxnodes:
+            break
+        for table in neighbours:
+            j = table[i]
+            if j not in cameFrom and passable[j] and j not in blocked:
+                cameFrom[j] = i
+                if j == g:
+                    return grid.path(cameFrom, s, g)
+                queue.append(j)
+    return []
+
+
+def astar(grid, start, goal, obstacles=(), maxnodes=None, heuristic=None):
+    """A* search: a shortest path from start to goal.
+
+    heuristic(i) must be an admissible estimate of the distance
+    from cell index i to the goal (default: toroidal Manhattan distance).
+    """
+    (s, g) = (grid.index(start), grid.index(goal))
+    blocked = grid.indices(obstacles)
+    if s == g or not grid.passable[g] or g in blocked:
+        return []
+    h = heuristic or grid.heuristic(g)
+    passable = grid.passable
+    neighbours = grid.neighbours
+    cameFrom = {s: s}
+    gscore = {s: 0}         # also the index of the open set
+    closed = set()
+    heap = [(h(s), 0, s)]   # (f, -g, i): on ties, prefer deeper nodes
+    expanded = 0
+    while heap:
+        (f, d, i) = heapq.heappop(heap)
+        if i in closed:     # stale entry
+            continue
+        if i == g:
+            return grid.path(cameFrom, s, g)
+        closed.add(i)
+        expanded += 1
+        if maxnodes is not None and expanded > maxnodes:
+            break
+        d = 1 - d
+        for table in neighbours:
+            j = table[i]
+            if passable[j] and j not in blocked and d < gscore.get(j, UNREACHABLE):
+                gscore[j] = d
+                cameFrom[j] = i
+                heapq.heappush(heap, (d + h(j), -d, j))
+    return []
+
+
+def bidirectional(grid, start, goal, obstacles=(), maxnodes=None):
+    """Bidirectional breadth-first search: a shortest path from start to goal."""
+    (s, g) = (grid.index(start), grid.index(goal))
+    blocked = grid.indices(obstacles)
+    if s == g or not grid.passable[g] or g in blocked:
+        return []
+    passable = grid.passable
+    neighbours = grid.neighbours
+    fromStart = {s: s}      # parent of each cell reached from start
+    fromGoal = {g: g}       # next cell towards goal of each cell reached from goal
+    frontS = [s]
+    frontG = [g]
+    expanded = 0
+    while frontS and frontG:
+        # Expand the smaller frontier, one whole level at a time
+        if len(frontS) <= len(frontG):
+            (front, parents, others) = (frontS, fromStart, fromGoal)
+        else:
+            (front, parents, others) = (frontG, fromGoal, fromStart)
+        newfront = []
+        meet = None
+        for i in front:
+            for table in neighbours:
+                j = table[i]
+                if j not in parents and passable[j] and j not in blocked:
+                    parents[j] = i
+                    if j in others:
+                        meet = j
+                        break
+                    newfront.append(j)
+            if meet is not None:
+                break
+        if meet is not None:
+            path = grid.path(fromStart, s, meet)
+            i = meet
+            while i != g:
+                i = fromGoal[i]
+                path.append(grid.point(i))
+            return path
+        expanded += len(front)
+        if maxnodes is not None and expanded > maxnodes:
+            break
+        if front is frontS:
+            frontS = newfront
+        else:
+            frontG = newfront
+    return []
+
+
+def repair(grid, start, path, obstacles=(), maxnodes=None, heuristic=None, goal=None):
+    """Repair a path found earlier (from a step next to start to its goal)
+    that may now go through obstacles, instead of searching it again.
+
+    Only the first blocked stretch of the path is replaced, by a shortest
+    detour (astar) from start to the first free cell after it; the rest of
+    the path is kept.  If goal is given and is a neighbour of the end of the
+    path (e.g. the food moved), the path is extended (or shortened) to it.
+    heuristic(i) may give the astar heuristic for goal cell index i
+    (e.g. DistanceOracle.heuristic).
+    Returns the path (the same list if nothing changed), or None if it
+    cannot be repaired: it does not start next to start, its goal is
+    blocked, or no detour was found within maxnodes.
+    """
+    if not path:
+        return None
+    index = grid.index
+    cells = [index(p) for p in path]
+    s = index(start)
+    if all(table[s] != cells[0] for table in grid.neighbours):
+        return None
+    if goal is not None and goal != path[-1]:
+        g = index(goal)
+        if len(cells) > 1 and cells[-2] == g:
+            (path, cells) = (path[:-1], cells[:-1])
+        elif any(table[cells[-1]] == g for table in grid.neighbours):
+            (path, cells) = (path + [goal], cells + [g])
+        else:
+            return None
+    passable = grid.passable
+    blocked = grid.indices(obstacles)
+    n = len(cells)
+    k = 0
+    while k < n and passable[cells[k]] and cells[k] not in blocked:
+        k += 1
+    if k == n:
+        return path
+    while k < n and not (passable[cells[k]] and cells[k] not in blocked):
+        k += 1
+    if k == n:
+        return None
+    h = heuristic(cells[k]) if heuristic is not None else None
+    detour = astar(grid, start, path[k], obstacles, maxnodes, h)
+    if not detour:
+        return None
+    return detour + path[k+1:]
+
+
+def floodfill(grid, start, obstacles=(), maxdist=UNREACHABLE-1):
+    """Distances from start to every cell reachable from it (up to maxdist).
+
+    Returns an array('H') indexed by cell index,
+    with UNREACHABLE for cells that were not reached.
+    """
+    s = grid.index(start)
+    passable = grid.passable
+    neighbours = grid.neighbours
+    blocked = grid.indices(obstacles)
+    dist = array('H', [UNREACHABLE])*len(passable)
+    dist[s] = 0
+    front = [s]
+    d = 0
+    while front and d < maxdist:
+        d += 1
+        newfront = []
+        for i in front:
+            for table in neighbours:
+                j = table[i]
+                if dist[j] == UNREACHABLE and passable[j] and j not in blocked:
+                    dist[j] = d
+                    newfront.append(j)
+        front = newfront
+    return dist
+
+
+def degrees(grid, passable=None):
+    """Number of passable neighbours of each cell (an array indexed by cell index)."""
+    if passable is None:
+        passable = grid.passable
+    degree = array('B', bytes(len(passable)))
+    for table in grid.neighbours:
+        for i, j in enumerate(table):
+            if passable[j]:
+                degree[i] += 1
+    return degree
+
+
+def deadends(grid):
+    """Passable cells that only lead to dead ends.
+
+    Cells with a single passable neighbour are removed, repeatedly,
+    until none is left (degree peeling, in linear time).
+    Returns the list of the indices of the removed cells, in removal order.
+    """
+    passable = bytearray(grid.passable)
+    neighbours = grid.neighbours
+    degree = degrees(grid, passable)
+    queue = deque(i for i in range(len(passable)) if passable[i] and degree[i] == 1)
+    removed = []
+    while queue:
+        i = queue.popleft()
+        if not passable[i] or degree[i] != 1:
+            continue
+        passable[i] = 0
+        removed.append(i)
+        for table in neighbours:
+            j = table[i]
+            if passable[j]:
+                degree[j] -= 1
+                if degree[j] == 1:
+                    queue.append(j)
+    return removed
+
+
+def corridors(grid):
+    """One-lane corridors: maximal chains of passable cells with exactly
+    two passable neighbours each.
+
+    Returns a list of chains, each a list of cell indices in order along
+    the corridor (so chain[0] and chain[-1] are its ends).
+    Takes linear time in the number of cells.
+    """
+    passable = grid.passable
+    neighbours = grid.neighbours
+    degree = degrees(grid)
+    inner = lambda j: passable[j] and degree[j] == 2
+    visited = bytearray(len(passable))
+    chains = []
+    for i in range(len(passable)):
+        if visited[i] or not inner(i):
+            continue
+        visited[i] = 1
+        chain = deque([i])
+        # Walk away from i in each of its two directions
+        for k, table in enumerate(neighbours):
+            j = table[i]
+            if not inner(j) or visited[j]:
+                continue
+            (prev, cur) = (i, j)
+            while inner(cur) and not visited[cur]:
+                visited[cur] = 1
+                if chain[0] == prev:
+                    chain.appendleft(cur)
+                else:
+                    chain.append(cur)
+                (prev, cur) = (cur, next(t[cur] for t in neighbours
+                                         if passable[t[cur]] and t[cur] != prev))
+        chains.append(list(chain))
+    return chains
+
+
+class DistanceOracle:
+    """Exact wall-aware distances between the passable cells of a Grid.
+
+    If the grid has at most maxcells passable cells, the distances between
+    all pairs are computed upfront into a single array('H').
+    Otherwise, the distances from a source are computed (by floodfill) when
+    first needed and kept in an LRU of at most maxrows rows.
+    In both cases, the distances from a few landmarks give cheap lower bounds
+    (ALT: |d(L,a) - d(L,b)| <= d(a,b)), which make good A* heuristics.
+
+    Distances ignore any obstacles other than the grid's (e.g. bodies),
+    so they are lower bounds of the distances with obstacles.
+    """
+
+    def __init__(self, grid, landmarks=4, maxcells=1024, maxrows=64, tables=None):
+        self.grid = grid
+        self.maxrows = maxrows
+        self.rows = OrderedDict()   # cell index -> distances from it (LRU)
+        self.free = array('I', [i for i, v in enumerate(grid.passable) if v])
+        self.slot = None            # cell index -> position in self.free (all-pairs only)
+        self.allpairs = None
+        if tables is not None:
+            self.landmarks = list(tables['landmarks'])
+            self.landmarkRows = splitRows(tables['landmarkrows'], len(grid.passable))
+            if 'allpairs' in tables:
+                self.setAllPairs(tables['allpairs'])
+        else:
+            self.chooseLandmarks(landmarks)
+            if len(self.free) <= maxcells:
+                self.computeAllPairs()
+
+    def chooseLandmarks(self, n):
+        """Choose n landmarks spread over the map (farthest-point heuristic)."""
+        self.landmarks = []
+        self.landmarkRows = []
+        if len(self.free) == 0:
+            return
+        mindist = floodfill(self.grid, self.grid.point(self.free[0]))
+        for _ in range(n):
+            # the cell farthest from all chosen landmarks (unreached cells first)
+            i = max(self.free, key=lambda i: mindist[i])
+            if self.landmarks and mindist[i] == 0:
+                break
+            row = floodfill(self.grid, self.grid.point(i))
+            self.landmarks.append(i)
+            self.landmarkRows.append(row)
+            for j in self.free:
+                if row[j] < mindist[j]:
+                    mindist[j] = row[j]
+
+    def computeAllPairs(self):
+        """Compute the distances between all pairs of passable cells."""
+        table = array('H')
+        for i in self.free:
+            row = floodfill(self.grid, self.grid.point(i))
+            table.extend(row[j] for j in self.free)
+        self.setAllPairs(table)
+
+    def setAllPairs(self, table):
+        self.allpairs = table
+        self.slot = array('i', [-1])*len(self.grid.passable)
+        for k, i in enumerate(self.free):
+            self.slot[i] = k
+
+    def tables(self):
+        """The precomputed tables (a dict of arrays), e.g. for mapcache."""
+        tables = {'landmarks': array('I', self.landmarks),
+                  'landmarkrows': array('H', [d for row in self.landmarkRows for d in row])}
+        if self.allpairs is not None:
+            tables['allpairs'] = self.allpairs
+        return tables
+
+    def row(self, i):
+        """Distances from cell index i to every cell (an array('H'))."""
+        row = self.rows.get(i)
+        if row is None:
+            row = floodfill(self.grid, self.grid.point(i))
+            self.rows[i] = row
+            if len(self.rows) > self.maxrows:
+                self.rows.popitem(last=False)
+        else:
+            self.rows.move_to_end(i)
+        return row
+
+    def distance(self, a, b):
+        """Exact distance between points a and b (UNREACHABLE if no path).
+
+        Like floodfill, a path may start on an impassable cell.
+        """
+        (i, j) = (self.grid.index(a), self.grid.index(b))
+        if self.allpairs is not None and self.slot[i] >= 0:
+            sj = self.slot[j]
+            return self.allpairs[self.slot[i]*len(self.free) + sj] if sj >= 0 else UNREACHABLE
+        return self.row(i)[j]
+
+    def lowerbound(self, a, b):
+        """A lower bound of the distance between points a and b, without searching
+        (the exact distance if it is at hand)."""
+        (i, j) = (self.grid.index(a), self.grid.index(b))
+        if self.allpairs is not None and self.slot[i] >= 0:
+            sj = self.slot[j]
+            return self.allpairs[self.slot[i]*len(self.free) + sj] if sj >= 0 else UNREACHABLE
+        if i in self.rows:
+            return self.rows[i][j]
+        return max(self.grid.heuristic(j)(i), self.landmarkBound(i, j))
+
+    def landmarkBound(self, i, j):
+        bound = 0
+        passable = self.grid.passable
+        for row in self.landmarkRows:
+            (di, dj) = (row[i], row[j])
+            if di == UNREACHABLE or dj == UNREACHABLE:
+                if di != dj and passable[i] and passable[j]:    # in different components
+                    return UNREACHABLE
+                continue
+            bound = max(bound, abs(di - dj))
+        return bound
+
+    def heuristic(self, goal):
+        """Return an admissible heuristic function h(i) for astar, given the goal cell index.
+
+        Uses exact distances if they are at hand, or landmark lower bounds.
+        """
+        if self.allpairs is not None and self.slot[goal] >= 0:
+            n = len(self.free)
+            (slot, table, base) = (self.slot, self.allpairs, self.slot[goal]*n)
+            return lambda i: table[base + slot[i]] if slot[i] >= 0 else UNREACHABLE
+        if goal in self.rows:
+            return self.rows[goal].__getitem__
+        manhattan = self.grid.heuristic(goal)
+        pairs = [(row, row[goal]) for row in self.landmarkRows if row[goal] != UNREACHABLE]
+        def h(i):
+            d = manhattan(i)
+            for (row, dg) in pairs:
+                di = row[i]
+                if di > dg + d:
+                    d = di - dg
+                elif dg > di + d:
+                    d = dg - di
+            return d
+        return h
+
+
+def splitRows(flat, n):
+    """Split a flat array into rows of length n."""
+    return [flat[k:k+n] for k in range(0, len(flat), n)]
+
+
+SEARCHES = [bfs, astar, bidirectional]
+
+
+## BENCHMARK (and tests)
+
+if __name__ == "__main__":
+    import mapfile
+    import random
+    import time
+    import sys
+
+    maps = sys.argv[1:] or ["maps/mapa1.bmp", "maps/mapa4.bmp"]
+    rnd = random.Random(20171106)
+
+    # All-pairs distances on a small world
+    world = World(Point(20,15), seed=1, grid=True)
+    world.generateWalls(8)
+    grid = Grid(world)
+    oracle = DistanceOracle(grid)
+    assert oracle.allpairs is not None
+    again = DistanceOracle(grid, tables=oracle.tables())
+    for k in range(200):
+        (a, b) = (world.randCoords(), world.randCoords())
+        d = floodfill(grid, a)[grid.index(b)]
+        assert oracle.distance(a, b) == again.distance(a, b) == d, (a, b)
+        assert oracle.lowerbound(a, b) <= d
+    wall = grid.passable.index(0)
+    assert oracle.heuristic(oracle.free[0])(wall) == UNREACHABLE
+    for filename in maps:
+        field = mapfile.load(filename)
+        world = World(Point(field.width, field.height), grid=True)
+        world.loadField(field)
+        grid = Grid(world)
+        free = [grid.point(i) for i in range(len(grid.passable)) if grid.passable[i]]
+        pairs = [(rnd.choice(free), rnd.choice(free)) for _ in range(200)]
+        obstacles = set(rnd.sample(free, 20))
+
+        t = time.perf_counter()
+        tables = {p: floodfill(grid, p) for p, _ in pairs}
+        t = time.perf_counter() - t
+        print("{}: {} free cells. floodfill: {:.3f} ms".format(filename, len(free), t/len(pairs)*1000))
+
+        t = time.perf_counter()
+        oracle = DistanceOracle(grid, maxcells=0)
+        print("  DistanceOracle: landmarks in {:.3f} ms".format((time.perf_counter() - t)*1000))
+        for (s, g) in pairs:
+            d = tables[s][grid.index(g)]
+            assert oracle.distance(s, g) == d
+            assert oracle.lowerbound(s, g) <= d
+        small = DistanceOracle(grid, maxcells=len(free), tables=oracle.tables())
+        assert small.landmarks == oracle.landmarks and small.allpairs is None
+        oracle.rows.clear()
+        altAstar = lambda grid, s, g, obstacles=(): astar(grid, s, g, obstacles,
+                                                          heuristic=oracle.heuristic(grid.index(g)))
+        altAstar.__name__ = "astar+ALT"
+
+        for search in SEARCHES + [altAstar]:
+            times = []
+            for (s, g) in pairs:
+                t = time.perf_counter()
+                path = search(grid, s, g)
+                times.append(time.perf_counter() - t)
+                # Check: valid path with the length found by floodfill
+                d = tables[s][grid.index(g)]
+                assert len(path) == (d if d != UNREACHABLE else 0), (search, s, g, len(path), d)
+                p = s
+                for q in path:
+                    assert grid.isPassable(q) and world.dist(p, q) == 1
+                    p = q
+                # Obstacles are avoided
+                path = search(grid, s, g, obstacles)
+                assert not obstacles.intersection(path)
+            times.sort()
+            print("  {:14} mean={:.3f} ms  median={:.3f} ms  max={:.3f} ms".format(search.__name__,
+                sum(times)/len(times)*1000, times[len(times)//2]*1000, times[-1]*1000))
+
+        # Repair paths blocked by a few cells somewhere near their start
+        (repaired, fresh) = ([], [])
+        for (s, g) in pairs:
+            path = astar(grid, s, g)
+            if len(path) < 10:
+                continue
+            k = rnd.randrange(len(path)//2)
+            block = {path[k]} | {world.translate(path[k], d) for d in DIRECTIONS if world.translate(path[k], d) != g}
+            t = time.perf_counter()
+            new = repair(grid, s, path, block)
+            repaired.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            best = astar(grid, s, g, block)
+            fresh.append(time.perf_counter() - t)
+            if new is None:     # no detour to the rest of the path
+                continue
+            assert new[-1] == g and not block.intersection(new) and len(new) >= len(best)
+            p = s
+            for q in new:
+                assert grid.isPassable(q) and world.dist(p, q) == 1
+                p = q
+        assert repair(grid, s, path, ()) is path
+        print("  {:14} mean={:.3f} ms  (astar from scratch: {:.3f} ms)".format("repair",
+            sum(repaired)/len(repaired)*1000, sum(fresh)/len(fresh)*1000))
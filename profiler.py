@@ -0,0 +1,185 @@
+# Lightweight instrumentation of the phases of the game loop.
+#
+# The game takes the time between consecutive points of its loop:
+#
+#     t = profiler.mark()
+#     moveFood(...)
+#     t = profiler.lap("moveFood", t)    # time since t, charged to moveFood
+#     player.vision()
+#     t = profiler.lap("vision", t)
+#
+# A Profiler keeps, for each phase, the number of laps, the total and
+# maximum times and a histogram of the lap times (in power-of-two buckets
+# of nanoseconds), and optionally a trace of every lap.  At the end it can
+# print a summary table, or write a JSON file in the Chrome trace event
+# format (open it in chrome://tracing or https://ui.perfetto.dev), with the
+# per-phase statistics in its "phases" field.
+#
+# NULLPROFILER has the same methods but does nothing, so the game always
+# calls the profiler, at a cost of two trivial method calls per phase.
+
+import threading
+import logging
+import json
+import time
+import os
+
+# Most lap events kept in a trace (the rest are only counted):
+MAXEVENTS = 500000
+# Number of histogram buckets (bucket k: laps of 2**(k-1) to 2**k-1 ns):
+BUCKETS = 48
+
+
+class PhaseStats:
+    """Statistics of the laps of a phase."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0    # s
+        self.max = 0.0      # s
+        self.histogram = [0]*BUCKETS
+
+    def add(self, d):
+        self.count += 1
+        self.total += d
+        if d > self.max:
+            self.max = d
+        self.histogram[min(int(d*1e9).bit_length(), BUCKETS-1)] += 1
+
+    def percentile(self, q):
+        """Upper bound of the q-th percentile of the lap times (s), from the histogram."""
+        rank = q/100*self.count
+        n = 0
+        for k, c in enumerate(self.histogram):
+            n += c
+            if n >= rank and c > 0:
+                return min((2**k)*1e-9, self.max)
+        return self.max
+
+    def asdict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'mean': self.total/self.count if self.count else 0.0,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'histogram': self.histogram}
+
+
+class Profiler:
+    """Collects the time spent in each phase of the game loop."""
+
+    enabled = True
+
+    def __init__(self, trace=False):
+        self.clock = time.perf_counter
+        self.phases = {}    # name -> PhaseStats, in order of first lap
+        self.events = [] if trace else None     # (name, start, duration, thread)
+        self.dropped = 0    # events not kept in the trace
+        self.start = self.clock()
+
+    def mark(self):
+        """Current time, to be passed to lap later."""
+        return self.clock()
+
+    def lap(self, name, t):
+        """Charge the time since t to phase name, and return the current time."""
+        now = self.clock()
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = PhaseStats(name)
+        stats.add(now - t)
+        if self.events is not None:
+            if len(self.events) < MAXEVENTS:
+                self.events.append((name, t, now - t, threading.get_ident()))
+            else:
+                self.dropped += 1
+        return now
+
+    def summary(self):
+        """A table with the statistics of each phase, as a string."""
+        lines = ["{:16} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            "phase", "count", "total ms", "mean us", "p50 us", "p99 us", "max us")]
+        for stats in self.phases.values():
+            lines.append("{:16} {:9d} {:10.1f} {:10.1f} {:10.1f} {:10.1f} {:10.1f}".format(
+                stats.name, stats.count, stats.total*1e3, stats.total/stats.count*1e6,
+                stats.percentile(50)*1e6, stats.percentile(99)*1e6, stats.max*1e6))
+        return "\n".join(lines)
+
+    def report(self):
+        """The statistics of each phase, as a dict (for JSON)."""
+        return {name: stats.asdict() for name, stats in self.phases.items()}
+
+    def write(self, filename):
+        """Write the statistics (and the trace, if any) to a JSON file
+        in the Chrome trace event format."""
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for (name, t, d, thread) in self.events or ():
+            tid = threads.setdefault(thread, len(threads))
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': (t - self.start)*1e6, 'dur': d*1e6})
+        with open(filename, "w") as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'droppedEvents': self.dropped, 'phases': self.report()}, f)
+        logging.info("Profile written to {}".format(filename))
+
+
+class NullProfiler:
+    """A Profiler that does nothing (used when profiling is off)."""
+
+    enabled = False
+
+    def mark(self):
+        return 0
+
+    def lap(self, name, t):
+        return 0
+
+    def summary(self):
+        return ""
+
+    def report(self):
+        return {}
+
+
+NULLPROFILER = NullProfiler()
+
+
+## TESTS
+
+if __name__ == "__main__":
+    import tempfile
+
+    def spin(seconds):
+        t = time.perf_counter()
+        while time.perf_counter() - t < seconds:
+            pass
+
+    profiler = Profiler(trace=True)
+    for k in range(20):
+        t = profiler.mark()
+        spin(0.001)
+        t = profiler.lap("short", t)
+        spin(0.004 if k == 7 else 0.002)
+        t = profiler.lap("long", t)
+    (short, long) = (profiler.phases["short"], profiler.phases["long"])
+    assert short.count == long.count == 20 and len(profiler.events) == 40
+    assert 0.020 <= short.total < 0.030 and 0.042 <= long.total < 0.060
+    assert 0.004 <= long.max < 0.006
+    assert short.percentile(50) <= 2*0.0011 and long.percentile(50) >= 0.002
+    print(profiler.summary())
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "profile.json")
+        profiler.write(filename)
+        with open(filename) as f:
+            data = json.load(f)
+        assert len(data['traceEvents']) == 40 and data['phases']['long']['count'] == 20
+
+    # The null profiler costs little more than an empty loop
+    null = NULLPROFILER
+    t = time.perf_counter()
+    for k in range(100000):
+        m = null.mark()
+        m = null.lap("phase", m)
+    t = time.perf_counter() - t
+    print("NullProfiler: {:.3f} us per lap".format(t/100000*1e6))
@@ -0,0 +1,340 @@
+# Record games in a compact binary log, and replay them without the agents.
+#
+# A Recorder attached to an AgentGame (AgentGame(..., record="game.llr"),
+# or start.py -r game.llr) writes:
+#   header:   HEADER + player names + walls
+#   records:  RECORD (kind, length) + payload, where the payload is either
+#     a KEYFRAME: the complete state after some number of rounds
+#                 (every `keyframes` rounds, starting with the initial state)
+#     a TURN:     what changed in one player's turn: the action, the foods
+#                 that moved (from->to), the food created after eating,
+#                 the nutrients of every player and the message sent.
+#
+# A Replay reads the log and reconstructs the state after any round by
+# loading the previous keyframe and applying the turns since then:
+#
+#     replay = Replay("game.llr")
+#     state = replay.seek(40000)
+#     print(state)
+#
+# Run this module as a script to show the state after a round:
+#   python3 replay.py game.llr 40000
+# or, without arguments, to run the tests.
+
+from array import array
+import struct
+import bisect
+import sys
+
+from world import *
+
+VERSION = 2
+MAGIC = b"LLRP"
+# magic, version, width, height, keyframe interval, number of players
+HEADER = struct.Struct('<4sHHHHB')
+# record kind, length of the payload
+RECORD = struct.Struct('<BI')
+# rounds played, number of foods
+KEYFRAME = struct.Struct('<II')
+# age, M, S, death cause, length of body  (one per player)
+PLAYER = struct.Struct('<IiiBI')
+# round, player, action, death cause, number of food moves, food created?, timespent, length of msg
+TURN = struct.Struct('<IBbBBBfH')
+
+# Record kinds:
+KEYFRAMERECORD = 1
+TURNRECORD = 2
+
+# Death causes (index 0: alive):
+CAUSES = [None, "invalid action", "timeout", "exception", "invalid message", "nutrients", "wall", "body"]
+
+# Default number of rounds between keyframes:
+KEYFRAMES = 500
+
+
+def pack(typecode, values):
+    """Bytes of an array of values (little-endian)."""
+    a = array(typecode, values)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a.tobytes()
+
+def cellTypecode(W, H):
+    """Typecode of the arrays of cell indices of a W x H world."""
+    return 'H' if W*H <= 1 << 16 else 'I'
+
+def unpack(typecode, data):
+    """Array of values from bytes produced by pack."""
+    a = array(typecode, data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+class Recorder:
+    """Writes the log of an AgentGame to a file, as the game is played."""
+
+    def __init__(self, filename, game, keyframes=KEYFRAMES):
+        self.world = game.world
+        self.players = game.allPlayers
+        self.keyframes = keyframes
+        self.rounds = 0         # rounds started
+        (W, H) = self.world.size
+        self.cell = cellTypecode(W, H)
+        self.moves = array(self.cell)   # foods moved in this turn (from, to, ...)
+        self.created = None     # food created in this turn
+        self.file = open(filename, "wb")
+        names = b"".join(bytes([len(name)]) + name.encode() for name in (p.name for p in self.players))
+        walls = sorted(self.world.index(p) for p in self.world.walls)
+        self.write(HEADER.pack(MAGIC, VERSION, W, H, keyframes, len(self.players)),
+                   names, struct.pack('<I', len(walls)), pack(self.cell, walls))
+
+    def write(self, *parts):
+        for part in parts:
+            self.file.write(part)
+
+    def startRound(self):
+        """Called before each round (writes a keyframe when it is due)."""
+        if self.rounds % self.keyframes == 0:
+            self.keyframe()
+        self.rounds += 1
+
+    def keyframe(self):
+        index = self.world.index
+        parts = [KEYFRAME.pack(self.rounds, len(self.world.food))]
+        for p in self.players:
+            parts.append(PLAYER.pack(p.age, p.nutrients['M'], p.nutrients['S'],
+                                     CAUSES.index(p.deathCause), len(p.body)))
+            parts.append(pack(self.cell, [index(q) for q in p.body]))
+        parts.append(pack(self.cell, [index(q) for q in self.world.food]))
+        parts.append(bytes(FOODTYPES.index(t) for t in self.world.food.values()))
+        self.record(KEYFRAMERECORD, b"".join(parts))
+
+    def foodMoved(self, p, p2):
+        self.moves.append(self.world.index(p))
+        self.moves.append(self.world.index(p2))
+
+    def foodCreated(self, p):
+        self.created = p
+
+    def endTurn(self, player, action):
+        """Called after each turn, with the action chosen by player."""
+        a = ACTIONS.index(action) if action in ACTIONS else -1
+        outbox = player.outbox if isinstance(player.outbox, bytes) else b""
+        parts = [TURN.pack(self.rounds, self.players.index(player), a, CAUSES.index(player.deathCause),
+                           len(self.moves)//2, self.created is not None, player.timespent, len(outbox)),
+                 pack(self.cell, self.moves)]
+        if self.created is not None:
+            parts.append(pack(self.cell, [self.world.index(self.created)]))
+        parts.append(pack('i', [p.nutrients[t] for p in self.players for t in "MS"]))
+        parts.append(outbox)
+        self.record(TURNRECORD, b"".join(parts))
+        self.moves = array(self.cell)
+        self.created = None
+
+    def record(self, kind, payload):
+        self.write(RECORD.pack(kind, len(payload)), payload)
+
+    def close(self):
+        self.keyframe()     # final state
+        self.file.close()
+
+
+class PlayerState:
+    """State of a player in a replay."""
+
+    def __init__(self, name):
+        self.name = name
+        self.age = 0
+        self.body = ()
+        self.nutrients = {'M': 0, 'S': 0}
+        self.deathCause = None
+        self.action = None      # last action
+        self.timespent = 0.0    # in the last turn (s)
+        self.outbox = b""       # last message sent
+
+    def __repr__(self):
+        return "({}, age={}, nutrients={}, head={})".format(self.name, self.age, self.nutrients, self.body[0])
+
+
+class State:
+    """State of a game after some number of rounds, reconstructed from a log."""
+
+    def __init__(self, world, names):
+        self.world = world
+        self.rounds = 0
+        self.players = [PlayerState(name) for name in names]
+        self.food = {}
+
+    def __repr__(self):
+        return "round {}: {}".format(self.rounds, "  ".join(str(p) for p in self.players))
+
+
+class Replay:
+    """A game log, opened for replaying."""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.data = data = f.read()
+        (magic, version, W, H, self.keyframes, n) = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{}: unknown format".format(filename))
+        self.world = World(Point(W, H))
+        self.cell = cellTypecode(W, H)
+        self.cellsize = c = array(self.cell).itemsize
+        k = HEADER.size
+        self.names = []
+        for _ in range(n):
+            length = data[k]
+            self.names.append(data[k+1:k+1+length].decode())
+            k += 1 + length
+        (nwalls,) = struct.unpack_from('<I', data, k)
+        k += 4
+        walls = unpack(self.cell, data[k:k+c*nwalls])
+        k += c*nwalls
+        for i in walls:
+            self.world.walls[self.world.cellPoint(i)] = WALL
+        # Offsets of all records, and of the keyframes:
+        self.records = []
+        self.keyframeRounds = []
+        self.keyframeRecords = []
+        while k + RECORD.size <= len(data):
+            (kind, length) = RECORD.unpack_from(data, k)
+            if k + RECORD.size + length > len(data):    # truncated (game interrupted)
+                break
+            if kind == KEYFRAMERECORD:
+                self.keyframeRounds.append(KEYFRAME.unpack_from(data, k + RECORD.size)[0])
+                self.keyframeRecords.append(len(self.records))
+            self.records.append(k)
+            k += RECORD.size + length
+        if not self.keyframeRecords:
+            raise ValueError("{}: no keyframes".format(filename))
+        # Rounds played (as far as the log goes):
+        last = self.records[-1] + RECORD.size
+        if data[self.records[-1]] == KEYFRAMERECORD:
+            self.rounds = self.keyframeRounds[-1]
+        else:
+            self.rounds = TURN.unpack_from(data, last)[0]
+
+    def seek(self, rounds):
+        """Return the State after the given number of rounds."""
+        rounds = max(0, min(rounds, self.rounds))
+        # (from the keyframe before, so the last actions and messages are known)
+        j = max(bisect.bisect_left(self.keyframeRounds, rounds) - 1, 0)
+        r = self.keyframeRecords[j]
+        state = self.readKeyframe(self.records[r])
+        for k in self.records[r+1:]:
+            # (the next keyframe is always after the rounds wanted)
+            if self.data[k] != TURNRECORD or TURN.unpack_from(self.data, k + RECORD.size)[0] > rounds:
+                break
+            self.applyTurn(state, k)
+        state.rounds = rounds
+        return state
+
+    def readKeyframe(self, k):
+        (data, cell, c) = (self.data, self.cell, self.cellsize)
+        cellPoint = self.world.cellPoint
+        state = State(self.world, self.names)
+        k += RECORD.size
+        (state.rounds, nfood) = KEYFRAME.unpack_from(data, k)
+        k += KEYFRAME.size
+        for player in state.players:
+            (player.age, m, s, cause, n) = PLAYER.unpack_from(data, k)
+            k += PLAYER.size
+            player.nutrients = {'M': m, 'S': s}
+            player.deathCause = CAUSES[cause]
+            player.body = tuple(cellPoint(i) for i in unpack(cell, data[k:k+c*n]))
+            k += c*n
+        positions = unpack(cell, data[k:k+c*nfood])
+        k += c*nfood
+        state.food = {cellPoint(i): FOODTYPES[t] for i, t in zip(positions, data[k:k+nfood])}
+        return state
+
+    def applyTurn(self, state, k):
+        """Apply the TURN record at offset k to state."""
+        (data, cell, c) = (self.data, self.cell, self.cellsize)
+        cellPoint = self.world.cellPoint
+        k += RECORD.size
+        (rounds, n, a, cause, nmoves, created, timespent, nmsg) = TURN.unpack_from(data, k)
+        k += TURN.size
+        moves = unpack(cell, data[k:k+2*c*nmoves])
+        k += 2*c*nmoves
+        for j in range(0, len(moves), 2):
+            (p, p2) = (cellPoint(moves[j]), cellPoint(moves[j+1]))
+            state.food[p2] = state.food.pop(p)
+        player = state.players[n]
+        player.age += 1     # (not always equal to rounds: a turn may be skipped when a player dies)
+        player.action = ACTIONS[a] if a >= 0 else None
+        player.deathCause = CAUSES[cause]
+        player.timespent = timespent
+        if player.deathCause is None and player.action != Stay:
+            head = self.world.translate(player.body[0], player.action)
+            player.body = (head,) + player.body[:-1]
+            if head in state.food:
+                t = state.food.pop(head)
+                state.food[cellPoint(unpack(cell, data[k:k+c])[0])] = t
+        if created:
+            k += c
+        nutrients = unpack('i', data[k:k+8*len(state.players)])
+        k += 8*len(state.players)
+        for j, p in enumerate(state.players):
+            p.nutrients = {'M': nutrients[2*j], 'S': nutrients[2*j+1]}
+        player.outbox = data[k:k+nmsg]
+
+
+## TESTS (or show the state after some round of a log)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        replay = Replay(sys.argv[1])
+        state = replay.seek(int(sys.argv[2]) if len(sys.argv) > 2 else replay.rounds)
+        print(state)
+        for player in state.players:
+            print("{}: action={} timespent={:.4f} cause={} message={!r}".format(player.name,
+                player.action, player.timespent, player.deathCause, player.outbox))
+        print("food:", state.food)
+        sys.exit()
+
+    import tempfile
+    import time
+    import os
+    from game import AgentGame
+    from agent1 import Agent1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "test.llr")
+        game = AgentGame(Agent1, seeds=("replay", "test"), savemap=None, record=filename)
+        game.recorder.keyframes = 100   # (before the first round)
+        # Keep the published state of each round to compare with the replay
+        states = []
+        publish = game.publish
+        def published():
+            publish()
+            states.append((tuple((p.age, p.body, dict(p.nutrients), p.deathCause) for p in game.allPlayers),
+                           dict(game.world.food)))
+        game.publish = published
+        score = game.start()
+        print("Game: score={} rounds={} log={} bytes".format(score, len(states), os.path.getsize(filename)))
+
+        t = time.perf_counter()
+        replay = Replay(filename)
+        assert replay.rounds == len(states)
+        for r in list(range(1, len(states)+1, 7)) + [len(states)]:
+            state = replay.seek(r)
+            (players, food) = states[r-1]
+            assert tuple((p.age, p.body, p.nutrients, p.deathCause) for p in state.players) == players, r
+            assert state.food == food, r
+        print("Replay: {} seeks in {:.3f} s".format(len(range(1, len(states)+1, 7)) + 1, time.perf_counter() - t))
+
+        # A world with more cells than 16-bit indices can address
+        game = AgentGame(Agent1, width=400, height=200, seeds=("replay", "large"), savemap=None, record=filename)
+        (game.mailbox, game.DISC) = (b"", 0)
+        for _ in range(50):
+            game.playRound()
+        game.recorder.close()
+        replay = Replay(filename)
+        assert replay.cell == 'I' and replay.rounds == 50
+        state = replay.seek(50)
+        assert [p.body for p in state.players] == [p.body for p in game.allPlayers]
+        assert state.food == game.world.food
+    print("OK")
@@ -0,0 +1,194 @@
+# Run agents in separate, long-lived processes.
+#
+# An AgentProcess stands in for an agent object inside the game:
+# the game sets its proprioception fields (.age, .body, .nutrients, .timespent)
+# and calls .chooseAction(vision, msg) as usual, but the real agent lives in
+# a child process.  So, an agent that crashes (or hangs) cannot take the game
+# down with it, and the CPU time charged to the agent is measured in the child,
+# excluding the game's own work.
+#
+# Per tick, the state is sent through a pipe in a compact binary encoding
+# (no pickling):
+#   request = HEADER + coords + codes + newnames + msg
+#     coords:   array('H') with x,y of body, vision.bodies and vision.food
+#     codes:    one byte per vision entry (index of the body name / food type)
+#     newnames: names of bodies not seen before (NUL-separated, utf-8)
+#   reply = REPLY + outbox
+
+from types import MappingProxyType
+import multiprocessing
+import logging
+import struct
+from array import array
+
+from world import *
+from timelimit import TimeLimit
+
+# age, M, S, timespent, limit, len(body), len(bodies), len(food), len(newnames), len(msg)
+HEADER = struct.Struct('<IiiddHHHHI')
+# action index, status, cpu time
+REPLY = struct.Struct('<bBd')
+
+# Reply status codes:
+OK = 0
+EXCEPTION = 1
+TIMEOUT = 2
+BADMESSAGE = 3
+
+# Action index for actions not in ACTIONS:
+BADACTION = -1
+
+# CPU time limit used in the child when the game sets none (s).
+NOLIMIT = 1e6
+
+# Extra real time allowed to the child before it is considered hung (s).
+GRACE = 2.0
+
+class AgentCrashed(Exception):
+    """The agent process died or stopped answering."""
+
+
+class AgentProcess:
+    """Proxy for an agent that runs in a child process."""
+
+    def __init__(self, AgentClass, name, body, world):
+        self.name = name
+        self.body = body
+        self.nutrients = {}
+        self.age = 0
+        self.timespent = 0.0
+        self.limit = None       # CPU time limit for the next call (s)
+        self.cputime = 0.0      # CPU time used by the child in the last call (s)
+        self.names = {}         # body name -> code already known by the child
+        self.size = world.size
+        (self.conn, child) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=agentMain,
+            args=(child, AgentClass, name, list(body), world.size, dict(world.walls), world.rnd.getstate()),
+            name="Agent-"+name, daemon=True)
+        self.process.start()
+        child.close()
+
+    def timeLimit(self, limit):
+        """A TimeLimit-like context manager for the next call to chooseAction."""
+        return ChildTimeLimit(self, limit)
+
+    def chooseAction(self, vision, msg):
+        coords = array('H')
+        for p in self.body:
+            coords.extend(p)
+        codes = bytearray()
+        newnames = []
+        for p, name in vision.bodies.items():
+            coords.extend(p)
+            code = self.names.get(name)
+            if code is None:
+                code = self.names[name] = len(self.names)
+                newnames.append(name)
+            codes.append(code)
+        for p, t in vision.food.items():
+            coords.extend(p)
+            codes.append(FOODTYPES.index(t))
+        newnames = "\0".join(newnames).encode()
+        limit = 0.0 if self.limit is None else self.limit    # 0 => no limit
+        header = HEADER.pack(self.age, self.nutrients['M'], self.nutrients['S'],
+            self.timespent, limit, len(self.body), len(vision.bodies),
+            len(vision.food), len(newnames), len(msg))
+        try:
+            self.conn.send_bytes(b"".join([header, coords.tobytes(), codes, newnames, msg]))
+            if not self.conn.poll(limit + GRACE if limit > 0 else None):
+                self.close()
+                self.cputime = limit
+                raise TimeoutError("Agent {} stopped answering.".format(self.name))
+            reply = self.conn.recv_bytes()
+        except (EOFError, OSError) as e:
+            self.close()
+            raise AgentCrashed("Agent {} process died.".format(self.name)) from e
+        (a, status, self.cputime) = REPLY.unpack_from(reply)
+        if status == TIMEOUT:
+            raise TimeoutError("Timeout reached.")
+        if status == EXCEPTION:
+            raise AgentCrashed("Agent {} raised an exception.".format(self.name))
+        action = ACTIONS[a] if a >= 0 else None
+        outbox = reply[REPLY.size:] if status != BADMESSAGE else None
+        return action, outbox
+
+    def close(self):
+        """Stop the child process."""
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.join(0.1)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+
+
+class ChildTimeLimit:
+    """Stands in for TimeLimit when the agent runs in a child process.
+
+    The limit is enforced in the child, and .elapsed is the child's CPU time.
+    """
+
+    def __init__(self, agentProcess, limit):
+        self.agentProcess = agentProcess
+        self.limit = limit
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.agentProcess.limit = self.limit
+        self.agentProcess.cputime = 0.0
+        return self
+
+    def __exit__(self, exctype, exc, tb):
+        self.elapsed = self.agentProcess.cputime
+        return False
+
+
+def agentMain(conn, AgentClass, name, body, size, walls, rndstate):
+    """Main loop of the child process: decode requests, call the agent, reply."""
+    world = World(size, grid=True)
+    world.rnd.setstate(rndstate)
+    world.walls.update(walls)
+    agent = AgentClass(name, body, world)
+    names = []
+    points = world.points
+    while True:
+        try:
+            request = conn.recv_bytes()
+        except (EOFError, OSError):
+            break
+        (agent.age, m, s, agent.timespent, limit, nbody, nbodies, nfood, nnames, nmsg) = HEADER.unpack_from(request)
+        agent.nutrients = MappingProxyType({'M': m, 'S': s})
+        n = nbody + nbodies + nfood
+        start = HEADER.size
+        coords = array('H', request[start:start+4*n])
+        start += 4*n
+        codes = request[start:start+nbodies+nfood]
+        start += nbodies + nfood
+        if nnames > 0:
+            names.extend(request[start:start+nnames].decode().split("\0"))
+        start += nnames
+        msg = request[start:start+nmsg]
+        pts = [points[coords[k+1]][coords[k]] for k in range(0, 2*n, 2)]
+        agent.body = tuple(pts[:nbody])
+        # (read-only, like the HorizonViews of an agent in the game's process)
+        bodies = MappingProxyType({p: names[c] for p, c in zip(pts[nbody:nbody+nbodies], codes)})
+        food = MappingProxyType({p: FOODTYPES[c] for p, c in zip(pts[nbody+nbodies:], codes[nbodies:])})
+
+        status = OK
+        a = BADACTION
+        outbox = b""
+        limiter = TimeLimit(limit if limit > 0 else NOLIMIT)
+        try:
+            with limiter:
+                (action, outbox) = agent.chooseAction(Vision(bodies, food), msg)
+            if action in ACTIONS:
+                a = ACTIONS.index(action)
+            if not isinstance(outbox, bytes):
+                (status, outbox) = (BADMESSAGE, b"")
+        except TimeoutError:
+            status = TIMEOUT
+        except Exception as e:
+            logging.exception(e)
+            status = EXCEPTION
+        conn.send_bytes(REPLY.pack(a, status, limiter.elapsed) + outbox)
+    conn.close()
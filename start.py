@@ -5,8 +5,15 @@
 # python3 start.py -s StudentAgent  # use another agent.
 # python3 start.py -d 1             # show a log of information messages (and above).
 # python3 start.py -d 0 -v          # run fast without video, show debug log
+# python3 start.py -x               # run each agent in a separate process
+# python3 start.py -t -f 10         # play at full speed, show 10 frames per second
+# python3 start.py -r game.llr      # record the game (see replay.py)
+# python3 start.py -v -p prof.json  # time the phases of the game loop (see profiler.py)
+# python3 start.py -k sampled:50    # check the bodies invariant every 50 rounds
+# python3 start.py -v -e game.lle   # log the events of each turn (see eventlog.py)
 
 from game import *
+from profiler import Profiler
 from agent1 import Agent1
 import importlib
 import logging
@@ -26,6 +33,13 @@ USAGE = \
           -f/--fps <FPS>
           -c/--calibrate
           -d/--debug Level(0--4)
+          -x/--sandbox
+          -t/--threaded           (simulation not limited by the display rate)
+          -r/--record <file>      (record the game, to replay it with replay.py)
+          -p/--profile <file>     (time the game loop, write a JSON/Chrome trace)
+          -k/--checks off|incremental|sampled[:N]|full
+                                  (how often to check the bodies, default incremental)
+          -e/--eventlog <file>    (log the events of each turn, in binary)
 """
 
 
@@ -44,9 +58,16 @@ def main(argv):
     studentAgent = Agent1
     debug = 2
     calibrate = False
+    sandbox = False
+    threaded = False
+    record = None
+    profile = None
+    checks = "incremental"
+    checkEvery = CHECKEVERY
+    eventlog = None
     
     try:
-        opts, args = getopt.getopt(argv,"hm:s:vf:cd:", ["help","map=", "student-agent=", "no-video", "fps=", "calibrate", "debug="])
+        opts, args = getopt.getopt(argv,"hm:s:vf:cd:xtr:p:k:e:", ["help","map=", "student-agent=", "no-video", "fps=", "calibrate", "debug=", "sandbox", "threaded", "record=", "profile=", "checks=", "eventlog="])
     except getopt.GetoptError as e:
         print(e)
         print(USAGE)
@@ -69,6 +90,23 @@ def main(argv):
             calibrate = True
         elif opt in ["-d", "--debug"]:
             debug = int(arg)
+        elif opt in ["-x", "--sandbox"]:
+            sandbox = True
+        elif opt in ["-t", "--threaded"]:
+            threaded = True
+        elif opt in ["-r", "--record"]:
+            record = arg
+        elif opt in ["-p", "--profile"]:
+            profile = arg
+        elif opt in ["-k", "--checks"]:
+            try:
+                (checks, checkEvery) = parseChecks(arg)
+            except ValueError as e:
+                print("Invalid checks mode {}: {}".format(arg, e))
+                print(USAGE)
+                sys.exit(2)
+        elif opt in ["-e", "--eventlog"]:
+            eventlog = arg
         
     logging.basicConfig(format='%(levelname)s:\t%(message)s', level=levels[debug]) 
     
@@ -88,14 +126,20 @@ def main(argv):
         print("Launching game.  PYTHONHASHSEED={} LONGLIFESEED={}".format(hashseed, seedstr))
         logging.info("Launching game.  PYTHONHASHSEED={} LONGLIFESEED={}".format(hashseed, seedstr))
         logging.info("cwd={!r} argv={!r} path={!r}".format(os.getcwd(), sys.argv, sys.path))
+        profiler = Profiler(trace=True) if profile != None else None
         game = AgentGame(AgentClass=studentAgent,
             width=60, height=40,
             filename=inputfile, walls=15,
             foodquant=4, timeslot=0.020, calibrate=calibrate,
             visual=visual, fps=fps, tilesize=20,
-            seeds=(seedstr[::2], seedstr[1::2]))
+            seeds=(seedstr[::2], seedstr[1::2]), sandbox=sandbox,
+            threaded=threaded, record=record, profiler=profiler,
+            checks=checks, checkEvery=checkEvery, eventlog=eventlog)
         score = game.start()
         print("Score:", score)
+        if profiler != None:
+            print(profiler.summary())
+            profiler.write(profile)
     except Exception as e:
         logging.exception(e)
         sys.exit(1)
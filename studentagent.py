@@ -1,29 +1,41 @@
 from agent import *
-import random,math,sys,collections,pickle,time, heapq
+import random,math,collections
+from array import array
+import pathfinding
+import mapcache
+import msgcodec
+
+# tipo das entradas da analise do mapa na cache (mudar se analyse_map mudar)
+MAPCACHEKIND = "studentagent-2"
+# numero maximo de nos expandidos ao procurar um desvio para reparar um caminho
+REPAIRNODES = 256
 
 class StudentAgent(Agent):
 
     def __init__(self, name, body, world):
         super().__init__(name, body, world)
+        self.analysis = mapcache.cached(self.world, MAPCACHEKIND, self.analyse_map) # analise estatica do mapa, guardada em disco
         self.fill_dead_ends() # busca os dead_ends e armazena-os num set juntamente com os pontos do self.world.walls
+        self.grid = pathfinding.Grid(self.world, blocked=self.dead_ends) # grelha para as pesquisas
+        self.oracle = pathfinding.DistanceOracle(self.grid, tables=self.analysis) # distancias reais (com paredes)
         self.path = collections.deque()
         # self.waypoints = self.find_waypoints()
         self.debug_dead_ends = [pos for pos in self.dead_ends if pos not in self.world.walls]
         self.areas = []
         self.areas = [set() for pos in range((int(self.world.size.x/20) + 1) * (int(self.world.size.y/20)+1))]
-        self.pointList = [Point(x,y) for y in range(self.world.size.y) for x in range(self.world.size.x)]
-
-        [self.areas[int(y/20) + int(x/20)].add(Point(x,y)) for y in range(self.world.size.y) for x in range(self.world.size.x)]
+        self.pointList = [self.world.cellPoint(i) for i in range(self.world.size.x*self.world.size.y)]
 
-        self.way_dead = set()
+        [self.areas[int(pos.y/20) + int(pos.x/20)].add(pos) for pos in self.pointList]
 
-        # self.graph = self.createGraph()
         self.dead_locks = self.dead_locks()
         #print(self.dead_locks)
         self.lastMsgSent = None
         self.inDeadLock = False
         self.msgToSend = b""
         self.otherAgentDead = False
+        # mensagens binarias compactas (2 bytes em vez de ~40 com pickle)
+        self.codec = msgcodec.Codec(self.world)
+        self.codec.register("deadlock", [("pos", msgcodec.POINT), ("taken", msgcodec.FLAG)])
 
 
     def chooseAction(self, vision, msg):
@@ -32,7 +44,7 @@ class StudentAgent(Agent):
             if msg == self.msgToSend:
                 self.otherAgentDead = True
             else:
-                dl,value = pickle.loads(msg)
+                _, (dl,value) = self.codec.decode(msg)
                 for border in self.dead_locks[dl].borders:
                     self.dead_locks[border].taken = value
 
@@ -47,7 +59,8 @@ class StudentAgent(Agent):
             elif self.nutrients['S'] < 1000:
                 food = [pos for (pos, food) in vision.food.items() if food == 'S'] 
 
-        food.sort(key=lambda x: self.distance(x, head))
+        # limite inferior da distancia real (contornando paredes), sem pesquisar
+        food.sort(key=lambda x: self.oracle.lowerbound(head, x))
         if food:
             direct_food = [pos for pos in food if not self.path_needed(head, pos, bodies)]
             if direct_food:
@@ -55,31 +68,23 @@ class StudentAgent(Agent):
                 return self.dead_lock_checker(nextpos[0],validact), self.msgToSend
 
             else:
-                new_path = self.search(head, food[0], bodies)
-                if self.path:
-                    nextpos = self.path[-1]
-                    if nextpos not in validact:
-                        goal = self.path[0]
-                        self.path = self.search(head, goal, bodies)
-
+                self.repair_path(head, bodies, vision.food)
+                # o oraculo da um limite inferior da distancia (sem corpos): se nao for
+                # menor que o caminho atual, uma pesquisa nova nao encontraria um caminho
+                # mais curto (e o limite nao obriga a um floodfill do mapa, como a distancia exata)
+                if not self.path or self.oracle.lowerbound(head, food[0]) < len(self.path):
+                    new_path = self.search(head, food[0], bodies)
                     if new_path:
-                        self.path = self.shortest_path(new_path, self.path)
-                elif new_path:
-                    self.path = new_path
+                        self.path = self.shortest_path(new_path, self.path) if self.path else new_path
                 if self.path:
                     nextpos = self.path.pop()
                     return self.dead_lock_checker(nextpos,validact), self.msgToSend
 
         else:
+            self.repair_path(head, bodies)
             if self.path:
-                nextpos = self.path[-1]
-                if nextpos not in validact:
-                    goal = self.path[0]
-                    self.path = self.search(head, goal, bodies)
-
-                if self.path:
-                    nextpos = self.path.pop()
-                    return self.dead_lock_checker(nextpos,validact), self.msgToSend
+                nextpos = self.path.pop()
+                return self.dead_lock_checker(nextpos,validact), self.msgToSend
 
         # return Stay, self.msgToSend
         
@@ -102,19 +107,18 @@ class StudentAgent(Agent):
     def dead_lock_checker(self, nextPos, validact):
         if self.otherAgentDead:
             return validact[nextPos]
-        dl = [x for x in self.dead_locks.keys() if x == nextPos]
-        if dl: #nextPos is a deadlock
+        if nextPos in self.dead_locks: #nextPos is a deadlock
             if self.dead_locks[nextPos].taken:
                 if (self.inDeadLock):
                     for border in self.dead_locks[nextPos].borders:
                         self.dead_locks[border].unlock()
-                    self.msgToSend = pickle.dumps((nextPos, False))
+                    self.msgToSend = self.codec.encode("deadlock", nextPos, False)
                     self.inDeadLock = False
                     return validact[nextPos]
                 else:
                     return Stay
             else:
-                self.msgToSend = pickle.dumps((nextPos,True)) #Encode message
+                self.msgToSend = self.codec.encode("deadlock", nextPos, True) #Encode message
                 #print(str(self.name) + ": MSG SEND: Message: " + str(self.msgToSend))
                 self.inDeadLock = True
                 for border in self.dead_locks[nextPos].borders:
@@ -153,45 +157,36 @@ class StudentAgent(Agent):
             dy = self.world.size.y - dy
         return math.hypot(dx,dy)
 
-    # Search A_Star com dicionários
-    def search(self, start, goal, bodies):
-        closedset = set() # coordenadas visitadas
-        openset = [start] # coordenadas por visitar
-        cameFrom = {} # dicionario/mapa, dada uma posicao retorna a posicao anterior
-        Gdict = collections.defaultdict(lambda: math.inf) # dicionario/mapa, dada uma posicao retorna o custo acumulado
-        Gdict[start] = 0
-        t0 = time.process_time()
-        t1 = time.process_time()
-        while t1 - t0 < 3 and openset != []:
-            current = openset[0]
-            if current == goal and current != start:
-                return self.find_path(cameFrom, current, start)
-
-            openset.remove(current)
-            closedset.add(current)
-            neighbors = list(self.valid_actions(current, bodies, closedset).keys())
-            neighbors.sort(key=lambda x: self.distance(x, goal))
-
-            for pos in neighbors:
-                gscore = Gdict[current] + self.distance(current,pos)
-
-                if gscore < Gdict[pos]:
-                    cameFrom[pos] = current
-                    Gdict[pos] = gscore
-
-            openset += [pos for pos in neighbors if pos not in openset]
-            t1 = time.process_time()
-        return []
-
+    # Search A* (pathfinding.astar), evitando dead_ends e bodies
+    # a heuristica vem do oraculo de distancias (landmarks), mais informada que a de Manhattan
     # devolve uma lifo sendo que o ultimo é na verdade a proxima posicao
-    def find_path(self, cameFrom, end, start):
-        current = end
-        deque = [current]
-        while cameFrom[current] != start:
-            current = cameFrom[current]
-            deque.append(current)
-
-        return deque
+    # maxnodes limita o numero de nos expandidos (None = sem limite)
+    def search(self, start, goal, bodies, maxnodes=None):
+        heuristic = self.oracle.heuristic(self.grid.index(goal))
+        path = pathfinding.astar(self.grid, start, goal, bodies, maxnodes, heuristic)
+        path.reverse()
+        return path
+
+    # repara o caminho atual em vez de o pesquisar de novo (pathfinding.repair):
+    # so o troco bloqueado por corpos e trocado por um desvio, o resto do caminho fica
+    # se a comida do objetivo se mexeu para uma posicao vizinha, o caminho e estendido ate ela
+    # se nao der para reparar (ex: o proximo passo ja nao e vizinho do head), pesquisa de novo
+    def repair_path(self, head, bodies, food=()):
+        if not self.path:
+            return
+        goal = self.path[0]
+        if food and goal not in food:
+            moved = [pos for pos in food if self.world.dist(pos, goal) == 1]
+            if moved:
+                goal = moved[0]
+        forward = self.path[::-1]
+        path = pathfinding.repair(self.grid, head, forward, bodies,
+                                  REPAIRNODES, self.oracle.heuristic, goal)
+        if path is None:
+            self.path = self.search(head, goal, bodies)
+        elif path is not forward:
+            path.reverse()
+            self.path = path
 
     # devolve um dicionário de pontos para ações
     # forbiden é um set de pontos para excluir, reduz os ciclos se for uma lista grande
@@ -203,25 +198,34 @@ class StudentAgent(Agent):
                 validact[newpos] = act
         return validact
 
+    # analise estatica do mapa, devolve um dict de arrays de indices de celulas:
+    # deadends: pontos que so levam a becos sem saida
+    # (pathfinding.deadends remove repetidamente os pontos com um so vizinho livre, em tempo linear)
+    # corridors: corredores de uma so via (pathfinding.corridors, em tempo linear)
+    # com pelo menos um troco reto, concatenados; corridorlens: comprimento de cada um
+    # landmarks, landmarkrows (e allpairs): tabelas do pathfinding.DistanceOracle
+    def analyse_map(self):
+        grid = pathfinding.Grid(self.world)
+        deadends = pathfinding.deadends(grid)
+        grid = pathfinding.Grid(self.world, blocked=[grid.point(i) for i in deadends])
+        chains = [c for c in pathfinding.corridors(grid) if len(c) > 1 and any(self.straight(grid, i) for i in c)]
+        analysis = {'deadends': array('I', deadends),
+                'corridors': array('I', [i for c in chains for i in c]),
+                'corridorlens': array('I', [len(c) for c in chains])}
+        # tabelas do oraculo de distancias (landmarks e, em mapas pequenos, todos os pares)
+        analysis.update(pathfinding.DistanceOracle(grid).tables())
+        return analysis
+
+    # verifica se a celula i tem paredes (ou dead_ends) dos dois lados, na vertical ou na horizontal
+    def straight(self, grid, i):
+        (up, down, right, left) = grid.neighbours
+        free = grid.passable
+        return (not free[up[i]] and not free[down[i]]) or (not free[right[i]] and not free[left[i]])
+
+    # dead_ends: paredes + pontos que so levam a becos sem saida
     def fill_dead_ends(self):
         self.dead_ends = set(self.world.walls.keys())
-        pointList= [] # lista de pontos que podem ser percorridos
-        for x in range(self.world.size.x):
-            for y in range(self.world.size.y):
-                pointList.append(Point(x,y))
-        pointList = [i for i in pointList if i not in self.dead_ends]
-        bodies = {}
-        for pos in pointList:
-            neighbors = self.valid_actions(pos, bodies)
-            empty = [i for i in neighbors if i not in self.dead_ends]
-            nextpos = pos
-            # porque um dead_end tem sempre 3 paredes e 1 bloco livre
-            while len(empty) == 1:
-                self.dead_ends.add(nextpos)
-                pointList = [i for i in pointList if i not in self.dead_ends]
-                nextpos = empty[0]
-                neighbors = self.valid_actions(nextpos, bodies)
-                empty = [i for i in neighbors if i not in self.dead_ends]
+        self.dead_ends.update(self.world.cellPoint(i) for i in self.analysis['deadends'])
 
     def find_waypoints(self):
         result = []
@@ -236,91 +240,19 @@ class StudentAgent(Agent):
                     result.append(pDiag)
         return set(result)
 
-    def createGraph(self):
-        g = Graph(self.world)
-        wayList = list(self.waypoints)
-        while wayList:
-            n1 = wayList.pop()
-            l = [x for x in wayList if not self.path_needed(n1,x,[])]
-            for p in l:
-                g.add(n1,p)
-        return g
-
-    # breadth_search
-    def closest_waypoint(self, point):
-        openset = set()
-        openset.add(point)
-        closedset = set()
-        while openset:
-            waypoints = [pos for pos in openset if pos in self.waypoints]
-            # apenas waypoints diretos, sem path
-            waypoints = [pos for pos in waypoints if not self.path_needed(point, pos, {})]
-            if waypoints:
-                return [waypoints[0]]
-            else:
-                closedset.update(openset)
-                for pos in openset.copy():
-                    s = self.valid_actions(pos, {})
-                    l = {pos for pos in s.keys() if pos not in closedset}
-                    openset.update(l)
-        return []
-
+    # dead_locks: corredores de uma so via com pelo menos um troco reto (ver analyse_map)
+    # dado um ponto fronteira do corredor devolve um objeto dead_lock_mutex, O(1)
     def dead_locks(self):
-        go = DIRECTIONS.copy()
         result = {}
-        # [(Up, Down), (Right, Left)]
-        tuple_go = [(go[0],go[1]), (go[2], go[3])]
-        # retira os dead_ends
-        empty_points = [pos for pos in self.pointList if pos not in self.dead_ends]
-        empty_points2 = set()
-        # por cada ponto na lista de pontos vazios nao visitados
-        for pos in empty_points:
-            if pos not in empty_points2:
-                # i é um tuplo no go
-                for i in range(2):
-                    p = self.world.translate(pos, tuple_go[i][0])
-                    poposite = self.world.translate(pos, tuple_go[i][1])
-                    if p in self.dead_ends and poposite in self.dead_ends:
-                        # constroi o "path" do deadlock_path, TODO curvas não funcionam por algum motivo
-                        self.way_dead.add(pos)
-                        dlocks1 = self.dead_lock_list(pos)
-                        # reconstroi a lista na mesma referencia
-                        empty_points2.update(dlocks1)
-                        # redundancia, dado um ponto como key num dicionario devolve um objeto dead_lock_mutex se existe, O(1)
-                        if dlocks1[0] != dlocks1[-1]:
-                            result[dlocks1[0]] = dead_lock_mutex(dlocks1)
-                            result[dlocks1[-1]] = dead_lock_mutex(dlocks1)
-                            break
-
+        corridors = self.analysis['corridors']
+        k = 0
+        for n in self.analysis['corridorlens']:
+            dlocks1 = [self.world.cellPoint(i) for i in corridors[k:k+n]]
+            k += n
+            result[dlocks1[0]] = dead_lock_mutex(dlocks1)
+            result[dlocks1[-1]] = dead_lock_mutex(dlocks1)
         return result
 
-    # dado um ponto entre duas paredes faz uma "Pesquisa Bidirecional em Profundidade"
-    def dead_lock_list(self, pos):
-        dlocks1 = [pos]
-        # pontos visitados no path
-        closedset = {pos}
-        # search numa direção
-        nextpos = list(self.valid_actions(pos, {}, forbiden=closedset).keys())
-        if not nextpos:
-            return [pos]
-
-        nextpos = [nextpos[0]]
-        # um dead_lock tem apena uma e uma só saida
-        while len(nextpos)==1:
-            dlocks1[0:0] = [nextpos[0]]
-            closedset.add(nextpos[0])
-            nextpos = list(self.valid_actions(nextpos[0], {}, forbiden=closedset).keys())
-
-        # search na direção oposta
-        nextpos = list(self.valid_actions(pos, {}, forbiden=closedset).keys())
-        while len(nextpos)==1:
-            dlocks1.append(nextpos[0])
-            closedset.add(nextpos[0])
-            nextpos = list(self.valid_actions(nextpos[0], {}, forbiden=closedset).keys())
-
-        dlocks1 = dlocks1[1:-1] 
-        return dlocks1
-
 class dead_lock_mutex():
     def __init__(self, dlocks):
         self.borders = {dlocks[0], dlocks[-1]}
@@ -335,47 +267,3 @@ class dead_lock_mutex():
     def unlock(self):
         self.taken = False
 
-
-from collections import defaultdict
-import world
-
-class Graph():
-
-    def __init__(self, world):
-        self.g = defaultdict(set)
-        self.world = world
-
-    def add(self, node1, node2):
-        if node1 == node2:
-            return
-        distance = self.world.dist(node1,node2)
-        self.g[node1].add((node2,distance))
-        self.g[node2].add((node1,distance))
-
-    def remove(self, node1, node2):
-        distance = self.world.dist(node1,node2)
-        self.g[node1].remove((node2,distance))
-        self.g[node2].remove((node1,distance))
-
-    def isConnected(self, node1, node2):
-        if node1 in self.g.keys() and [item for item in self.g[node1] if item[0] == node2]:
-            return True
-        return False
-
-    def neighbors(self,node1):
-        return [a for (a,b) in self.g[node1]]
-
-    def cost(self, node1, node2):
-        if not self.isConnected(node1,node2):
-            return None
-        return {b for a,b in self.g[node1] if a == node2}.pop()
-
-if __name__ == "__main__": # DEBUG Graph
-    w = World(Point(5,5))
-    h = Graph(w)
-    h.add(Point(2,2), Point(3,2))
-    h.add(Point(2,2), Point(4,4))
-    print(h.isConnected(Point(2,2),Point(3,2)))
-    print(h.cost(Point(2,2),Point(3,2)))
-    print(h.neighbors(Point(2,2)))
-    print(h.g)
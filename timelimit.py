@@ -0,0 +1,203 @@
+# Time limits measured in CPU time, with sub-millisecond resolution.
+#
+# Used by the game to interrupt agents that think for longer than their
+# nutrients allow:
+#
+#     with TimeLimit(0.5) as limit:
+#         long_computation()        # raises TimeoutError after 0.5 s of CPU
+#     print(limit.elapsed)          # CPU time used by the block
+#
+# In the main thread (on UNIX), the limit is enforced with an ITIMER_REAL
+# interval timer, which has sub-millisecond resolution (unlike ITIMER_PROF,
+# which only advances at each kernel tick).  Since CPU time never advances
+# faster than real time, the timer never fires before the CPU budget is used;
+# if it fires early (the process was waiting), it is simply set again for
+# the remaining budget.
+# In other threads (or where setitimer is not available), a watchdog thread
+# measures the CPU time of the limited thread and interrupts it.
+
+import threading
+import logging
+import sys
+import signal
+import ctypes
+import time
+
+# Smallest limit that can be set (a zero limit would disarm the timer):
+MINLIMIT = 1e-6
+
+
+class TimeLimit:
+    """Context manager that raises TimeoutError in its block
+    if the block uses more than limit seconds of CPU time.
+
+    On exit, .elapsed holds the CPU time used by the block (in seconds).
+    Limits may not be nested.
+    """
+
+    active = None   # TimeLimit currently armed with the interval timer
+
+    def __init__(self, limit):
+        self.limit = max(limit, MINLIMIT)
+        self.elapsed = 0.0
+        self.expired = False
+        self.watchdog = None
+
+    def __enter__(self):
+        if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+            installHandler()
+            self.clock = time.process_time
+            self.start = self.clock()
+            TimeLimit.active = self
+            signal.setitimer(signal.ITIMER_REAL, self.limit)
+        else:
+            self.watchdog = Watchdog(self)
+            self.clock = self.watchdog.clock
+            self.start = self.clock()
+            self.watchdog.start()
+        return self
+
+    def __exit__(self, exctype, exc, tb):
+        # The timeout may still be raised in here, skipping the rest:
+        # so .elapsed is set first (expire sets it too), and the watchdog
+        # restores the switch interval itself.
+        self.elapsed = self.clock() - self.start
+        if self.watchdog is None:
+            TimeLimit.active = None     # (from now on, the signal is ignored)
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        else:
+            self.watchdog.stop()
+        return False
+
+    def remaining(self):
+        """CPU time left before the limit is reached."""
+        return self.limit - (self.clock() - self.start)
+
+    def expire(self):
+        """Called when the limit is reached."""
+        self.expired = True
+        self.elapsed = self.clock() - self.start
+        logging.debug("TimeLimit expired: limit=%.6f", self.limit)
+
+
+def alarmHandler(signum, frame):
+    """Handler for SIGALRM: interrupt the block of the active TimeLimit."""
+    limit = TimeLimit.active
+    if limit is None:   # late signal, block already finished
+        return
+    remaining = limit.remaining()
+    if remaining > 0:   # woke up too early (the process was not running)
+        signal.setitimer(signal.ITIMER_REAL, remaining)
+        return
+    TimeLimit.active = None
+    limit.expire()
+    raise TimeoutError("Timeout reached.")
+
+def installHandler():
+    """Install the SIGALRM handler (only once)."""
+    if signal.getsignal(signal.SIGALRM) is not alarmHandler:
+        signal.signal(signal.SIGALRM, alarmHandler)
+
+
+class Watchdog(threading.Thread):
+    """Thread that interrupts another thread when it exceeds a TimeLimit.
+
+    While it runs, the interpreter switch interval is shortened,
+    so that the watchdog gets the GIL soon after it wakes up
+    (the watchdog restores it when it ends, even if the watched thread
+    is interrupted while stopping it).
+    """
+
+    SWITCHINTERVAL = 0.0002
+
+    def __init__(self, limit):
+        super().__init__(daemon=True)
+        self.limit = limit
+        self.target = threading.get_ident()     # the thread to watch
+        self.done = threading.Event()
+        self.lock = threading.Lock()    # so that stop() and expiring never overlap
+        try:
+            clockid = time.pthread_getcpuclockid(self.target)
+            self.clock = lambda: time.clock_gettime(clockid)
+        except AttributeError:
+            # Operating System has no per-thread CPU clocks.
+            self.clock = time.process_time
+
+    def start(self):
+        self.switchinterval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.switchinterval, self.SWITCHINTERVAL))
+        super().start()
+
+    def run(self):
+        try:
+            self.watch()
+        finally:
+            sys.setswitchinterval(self.switchinterval)
+
+    def watch(self):
+        limit = self.limit
+        while True:
+            remaining = limit.limit - (self.clock() - limit.start)
+            if remaining <= 0:
+                break
+            # CPU time never advances faster than real time, so it is safe
+            # to sleep for the remaining CPU time before checking again.
+            if self.done.wait(remaining):
+                return
+        with self.lock:
+            if not self.done.is_set():
+                limit.expire()
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_ulong(self.target), ctypes.py_object(TimeoutError))
+
+    def stop(self):
+        with self.lock:
+            self.done.set()
+        self.join()
+
+
+## TESTS
+
+if __name__ == "__main__":
+
+    def spin(seconds):
+        """Burn CPU for about the given number of seconds."""
+        t = time.process_time()
+        while time.process_time() - t < seconds:
+            pass
+
+    def check(limit, work):
+        try:
+            with TimeLimit(limit) as tl:
+                spin(work)
+        except TimeoutError:
+            pass
+        return tl
+
+    # Within the limit: not interrupted
+    tl = check(0.050, 0.010)
+    assert not tl.expired and tl.elapsed < 0.050, tl.elapsed
+    # Over the limit: interrupted close to the limit
+    tl = check(0.020, 1.0)
+    assert tl.expired and 0.020 <= tl.elapsed < 0.022, tl.elapsed
+    print("main thread: elapsed={:.6f}".format(tl.elapsed))
+
+    # Same thing in a secondary thread (uses the watchdog)
+    switchinterval = sys.getswitchinterval()
+    results = []
+    th = threading.Thread(target=lambda: results.extend([check(0.050, 0.010), check(0.020, 1.0)]))
+    th.start()
+    th.join()
+    assert not results[0].expired
+    assert results[1].expired and 0.020 <= results[1].elapsed < 0.025, results[1].elapsed
+    assert sys.getswitchinterval() == switchinterval
+    print("other thread: elapsed={:.6f}".format(results[1].elapsed))
+
+    # .elapsed is set when the limit expires, even if __exit__ is cut short
+    tl = TimeLimit(0.010)
+    tl.__enter__()
+    try:
+        spin(1.0)
+    except TimeoutError:
+        pass
+    assert tl.expired and 0.010 <= tl.elapsed < 0.012 and TimeLimit.active is None, tl.elapsed
@@ -0,0 +1,215 @@
+# Run this script to play many headless games in parallel and collect a report.
+# Examples:
+# python3 tournament.py -s StudentAgent -m maps/mapa1.bmp -n 0:100
+#       # 100 seeds on mapa1, one game per core
+# python3 tournament.py -s StudentAgent -r -m maps/mapa1.bmp -m maps/mapa2.bmp -n 0:500 -o nightly.csv
+#       # random maps plus two fixed maps, report written as CSV
+# python3 tournament.py -s StudentAgent -m maps/mapa3.bmp -n 7 -o seed7.json
+#       # a single seed, report written as JSON
+# python3 tournament.py -s StudentAgent -m maps/mapa1.bmp -n 0:20 -p -o prof.csv
+#       # also report the mean time of each phase of the game loop (in us)
+#
+# Each game gets a LONGLIFESEED derived from its seed number, so any game in
+# the report can be replayed with:
+#   LONGLIFESEED=<longlifeseed> python3 start.py -m <map> -s <agent>
+# (use the same PYTHONHASHSEED as the tournament for exact repetition).
+
+from game import *
+from start import ALPHABET
+from profiler import Profiler
+import calibration
+import multiprocessing
+import importlib
+import logging
+import random
+import sys
+import os
+import getopt
+import json
+import csv
+import time
+
+USAGE = \
+"""tournament.py [-h/--help
+          -s/--student-agent AgentName
+          -m/--map <mapfile>      (may be repeated)
+          -r/--random             (also play on randomly generated maps)
+          -n/--seeds <first>:<last+1> or <seed>
+          -j/--jobs <N>           (default: number of available cores)
+          -o/--output <file.csv|file.json>
+          -c/--calibrate
+          -p/--profile            (report the mean time of each phase of the game loop)
+          -k/--checks off|incremental|sampled[:N]|full
+                                  (how often to check the bodies, default incremental)
+          -d/--debug Level(0--4)
+"""
+
+# Map name used in the report for randomly generated maps:
+RANDOMMAP = "random"
+
+
+def seedString(seed):
+    """Return the LONGLIFESEED string used for a given seed number."""
+    rnd = random.Random(seed)
+    return ''.join(rnd.choice(ALPHABET) for _ in range(20))
+
+
+def availableCores():
+    """Number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Operating System may not support getaffinity.
+        return os.cpu_count() or 1
+
+
+def initWorker(level):
+    """Initialize logging in a worker process."""
+    logging.basicConfig(format='%(levelname)s:\t%(processName)s:\t%(message)s', level=level)
+
+
+def playGame(job):
+    """Play a single headless game and return its report row (a dict)."""
+    (agentName, mapfile, seed, calibrate, profile, checks, checkEvery) = job
+    seedstr = seedString(seed)
+    row = {'map': mapfile, 'seed': seed, 'longlifeseed': seedstr}
+    t = time.perf_counter()
+    try:
+        classmodule = importlib.import_module(agentName.lower())
+        studentAgent = getattr(classmodule, agentName)
+        profiler = Profiler() if profile else None
+        game = AgentGame(AgentClass=studentAgent,
+            width=60, height=40,
+            filename=None if mapfile == RANDOMMAP else mapfile, walls=15,
+            foodquant=4, timeslot=0.020, calibrate=calibrate,
+            visual=False, seeds=(seedstr[::2], seedstr[1::2]), savemap=None,
+            profiler=profiler, checks=checks, checkEvery=checkEvery)
+        row['score'] = game.start()
+        for player in game.allPlayers:
+            row[player.name+'.age'] = player.age
+            row[player.name+'.cause'] = player.deathCause
+        if profiler != None:
+            for name, stats in profiler.phases.items():
+                row[name+'.us'] = round(stats.total/stats.count*1e6, 1)
+        row['error'] = None
+    except Exception as e:
+        logging.exception(e)
+        row['score'] = None
+        row['error'] = repr(e)
+    row['walltime'] = round(time.perf_counter() - t, 3)
+    return row
+
+
+def writeReport(rows, outputfile):
+    """Write report rows to a CSV or JSON file (chosen by the file extension)."""
+    if outputfile.endswith(".json"):
+        with open(outputfile, "w") as f:
+            json.dump(rows, f, indent=1)
+    else:
+        fields = []
+        for row in rows:
+            fields.extend(k for k in row if k not in fields)
+        with open(outputfile, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def parseSeeds(arg):
+    """Parse a seed range "A:B" (A included, B excluded) or a single seed "A"."""
+    if ":" in arg:
+        (a, b) = arg.split(":")
+        return range(int(a), int(b))
+    return range(int(arg), int(arg)+1)
+
+
+def main(argv):
+
+    levels = [logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL]
+
+    maps = []
+    seeds = range(0, 10)
+    agentName = "Agent1"
+    jobs = availableCores()
+    outputfile = None
+    debug = 2
+    calibrate = False
+    profile = False
+    checks = "incremental"
+    checkEvery = CHECKEVERY
+
+    try:
+        opts, args = getopt.getopt(argv,"hs:m:rn:j:o:cpk:d:", ["help", "student-agent=", "map=", "random", "seeds=", "jobs=", "output=", "calibrate", "profile", "checks=", "debug="])
+    except getopt.GetoptError as e:
+        print(e)
+        print(USAGE)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ["-h", "--help"]:
+            print(USAGE)
+            sys.exit()
+        elif opt in ["-s", "--student-agent"]:
+            agentName = arg
+        elif opt in ["-m", "--map"]:
+            maps.append(arg)
+        elif opt in ["-r", "--random"]:
+            maps.append(RANDOMMAP)
+        elif opt in ["-n", "--seeds"]:
+            seeds = parseSeeds(arg)
+        elif opt in ["-j", "--jobs"]:
+            jobs = int(arg)
+        elif opt in ["-o", "--output"]:
+            outputfile = arg
+        elif opt in ["-c", "--calibrate"]:
+            calibrate = True
+        elif opt in ["-p", "--profile"]:
+            profile = True
+        elif opt in ["-k", "--checks"]:
+            try:
+                (checks, checkEvery) = parseChecks(arg)
+            except ValueError as e:
+                print("Invalid checks mode {}: {}".format(arg, e))
+                print(USAGE)
+                sys.exit(2)
+        elif opt in ["-d", "--debug"]:
+            debug = int(arg)
+
+    if not maps:
+        maps = [RANDOMMAP]
+
+    logging.basicConfig(format='%(levelname)s:\t%(message)s', level=levels[debug])
+
+    if calibrate:
+        # Measure (or load) the calibration once, so the games find it cached
+        calibration.calibration()
+    
+    hashseed = os.environ.get("PYTHONHASHSEED", "random")
+    joblist = [(agentName, m, s, calibrate, profile, checks, checkEvery) for m in maps for s in seeds]
+    print("Launching {} games on {} cores.  PYTHONHASHSEED={}".format(len(joblist), jobs, hashseed))
+
+    rows = []
+    t = time.perf_counter()
+    with multiprocessing.Pool(jobs, initializer=initWorker, initargs=(levels[debug],)) as pool:
+        for row in pool.imap_unordered(playGame, joblist):
+            rows.append(row)
+            logging.info("{map} seed={seed}: score={score}".format(**row))
+    t = time.perf_counter() - t
+    rows.sort(key=lambda row: (maps.index(row['map']), row['seed']))
+
+    if outputfile != None:
+        writeReport(rows, outputfile)
+
+    ## Summary per map
+    for m in maps:
+        scores = [row['score'] for row in rows if row['map'] == m and row['score'] != None]
+        failed = sum(1 for row in rows if row['map'] == m and row['score'] == None)
+        if scores:
+            print("{}: games={} mean={:.1f} min={} max={} failed={}".format(
+                m, len(scores), sum(scores)/len(scores), min(scores), max(scores), failed))
+        else:
+            print("{}: no games completed, failed={}".format(m, failed))
+    print("Total time: {:.1f} s".format(t))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
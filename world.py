@@ -5,11 +5,16 @@
 
 from collections import namedtuple
 from collections import ChainMap
-from collections import deque
+from collections.abc import Mapping
+from collections import OrderedDict
+from itertools import compress
+from array import array
 #from enum import Enum
 import logging
 import random
 
+import mapfile
+
 class Point(namedtuple("Point", ['x', 'y'])):
     """A Point is a tuple of coordinates inside a 2D world.
     
@@ -40,6 +45,285 @@ class Point(namedtuple("Point", ['x', 'y'])):
         """
         return str(tuple(self))
 
+class SpatialIndex:
+    """Points of a toroidal world, bucketed in square blocks of cells.
+
+    Used to find the points near a given position
+    while only looking at the blocks that overlap its neighbourhood.
+    """
+
+    def __init__(self, size, blocksize=8):
+        self.size = size
+        self.blocksize = blocksize
+        self.ncols = -(-size.x//blocksize)   # number of blocks along x (ceil)
+        self.nrows = -(-size.y//blocksize)   # number of blocks along y (ceil)
+        self.buckets = [set() for _ in range(self.ncols*self.nrows)]
+
+    def bucket(self, p):
+        """The set of points in the block that contains p."""
+        B = self.blocksize
+        return self.buckets[p[0]%self.size.x//B + p[1]%self.size.y//B*self.ncols]
+
+    def add(self, p):
+        self.bucket(p).add(p)
+
+    def discard(self, p):
+        self.bucket(p).discard(p)
+
+    def clear(self):
+        for b in self.buckets:
+            b.clear()
+
+    def near(self, center, radius):
+        """Iterate over the points in the blocks within radius (per axis) of center."""
+        (W, H) = self.size
+        B = self.blocksize
+        (cx, cy) = center
+        if 2*radius+1 >= W:
+            cols = range(self.ncols)
+        else:
+            cols = {x%W//B for x in range(cx-radius, cx+radius+1)}
+        if 2*radius+1 >= H:
+            rows = range(0, self.nrows*self.ncols, self.ncols)
+        else:
+            rows = {y%H//B*self.ncols for y in range(cy-radius, cy+radius+1)}
+        for r in rows:
+            for c in cols:
+                yield from self.buckets[r+c]
+
+
+class CellMap(dict):
+    """A dict of {Point: content} that keeps the grid of a World in sync.
+
+    In grid mode, World.walls, .food and .bodies are CellMaps,
+    so code that changes those dicts directly also updates World.grid.
+    CellMaps created with spatial=True also keep their keys in a SpatialIndex,
+    used by World.within.
+    """
+
+    def __init__(self, world, code, spatial=False):
+        super().__init__()
+        self.world = world
+        self.code = code    # grid code for the cells in this map
+        self.spatial = SpatialIndex(world.size) if spatial else None
+
+    def __setitem__(self, pos, content):
+        super().__setitem__(pos, content)
+        i = self.world.index(pos)
+        grid = self.world.grid
+        if grid[i] < self.code:     # bodies cover food, food covers walls
+            if grid[i] == EMPTYCELL and self.world.samplers:
+                self.world.cellChanged(i, False)
+            grid[i] = self.code
+        if self.spatial is not None:
+            self.spatial.add(pos)
+
+    def __delitem__(self, pos):
+        super().__delitem__(pos)
+        self.removed(pos)
+
+    def removed(self, pos):
+        """Update the grid and index after pos was removed from this map."""
+        self.world.updateCell(pos)
+        if self.spatial is not None:
+            self.spatial.discard(pos)
+
+    def pop(self, pos, *default):
+        if pos not in self:
+            return super().pop(pos, *default)
+        content = super().pop(pos)
+        self.removed(pos)
+        return content
+
+    def popitem(self):
+        (pos, content) = super().popitem()
+        self.removed(pos)
+        return (pos, content)
+
+    def setdefault(self, pos, default=None):
+        if pos not in self:
+            self[pos] = default
+        return self[pos]
+
+    def update(self, *args, **kwargs):
+        for pos, content in dict(*args, **kwargs).items():
+            self[pos] = content
+
+    def fill(self, positions, content):
+        """Set content in a list of (normalized) positions, faster than one by one."""
+        if self.spatial is not None or self.world.samplers:
+            for pos in positions:
+                self[pos] = content
+            return
+        super().update(dict.fromkeys(positions, content))
+        index = self.world.index
+        grid = self.world.grid
+        code = self.code
+        for pos in positions:
+            i = index(pos)
+            if grid[i] < code:
+                grid[i] = code
+
+    def clear(self):
+        cells = list(self)
+        super().clear()
+        for pos in cells:
+            self.removed(pos)
+
+
+class GridCells(ChainMap):
+    """ChainMap of bodies, food and walls with membership tests done on the grid."""
+
+    def __init__(self, world):
+        super().__init__(world.bodies, world.food, world.walls)
+        self.world = world
+
+    def __contains__(self, pos):
+        return self.world.grid[self.world.index(pos)] != EMPTYCELL
+
+    def get(self, pos, default=None):
+        if self.world.grid[self.world.index(pos)] == EMPTYCELL:
+            return default
+        return super().get(pos, default)
+
+
+class HorizonView(Mapping):
+    """A read-only view of the entries of env within distance radius of center.
+
+    env is one of the dicts of a world (e.g. world.food).
+    Membership tests and lookups only check the given position;
+    the entries within the horizon are only collected (once) if the view
+    is iterated.  The view reflects the world at the time it is used,
+    so it should not be kept after the world changes.
+    The world and env are private (agents get only the Mapping interface).
+    """
+
+    __slots__ = ('__world', '__env', 'center', 'radius', '__entries')
+
+    def __init__(self, world, env, center, radius):
+        self.__world = world
+        self.__env = env
+        self.center = center
+        self.radius = radius
+        self.__entries = None
+
+    def __contains__(self, p):
+        return p in self.__env and self.__world.dist(p, self.center) <= self.radius
+
+    def __getitem__(self, p):
+        if p in self:
+            return self.__env[p]
+        raise KeyError(p)
+
+    def get(self, p, default=None):
+        return self.__env[p] if p in self else default
+
+    def collect(self):
+        """Return a dict with all the entries in view."""
+        if self.__entries is None:
+            self.__entries = self.__world.within(self.__env, self.center, self.radius)
+        return self.__entries
+
+    def __iter__(self):
+        return iter(self.collect())
+
+    def __len__(self):
+        return len(self.collect())
+
+    def keys(self):
+        return self.collect().keys()
+
+    def items(self):
+        return self.collect().items()
+
+    def values(self):
+        return self.collect().values()
+
+    def __repr__(self):
+        return "HorizonView({!r})".format(self.collect())
+
+
+class Vision:
+    """What an agent sees: the .bodies and .food within its horizon.
+
+    Both are read-only mappings of {Point: content}.
+    """
+
+    __slots__ = ('bodies', 'food')
+
+    def __init__(self, bodies, food):
+        self.bodies = bodies
+        self.food = food
+
+
+class NoFreeCell(Exception):
+    """There is no free cell where to put something."""
+
+
+class FreeCells:
+    """The free cells among a list of cells of a World (in grid mode).
+
+    Kept up to date by the World as cells are filled and emptied.
+    .select(k) returns the k-th free cell in list order, in O(log n),
+    so a random draw picks the same cell as rnd.choice would pick
+    from the filtered list, without building that list.
+    (The list of cells should not have repeated cells.)
+    """
+
+    def __init__(self, world, cells):
+        self.cells = array('i', cells)  # cell indices, in list order
+        n = len(self.cells)
+        self.slot = array('i', [-1])*len(world.grid)    # cell index -> position in cells
+        self.free = bytearray(n)
+        self.tree = array('i', [0])*(n+1)   # Fenwick tree of the free flags
+        for k, i in enumerate(self.cells):
+            self.slot[i] = k
+            if world.grid[i] == EMPTYCELL:
+                self.free[k] = 1
+                self.tree[k+1] += 1
+        for k in range(1, n+1):     # build the tree in linear time
+            parent = k + (k & -k)
+            if parent <= n:
+                self.tree[parent] += self.tree[k]
+        self.count = sum(self.free)
+        self.top = 1 << (n.bit_length() - 1) if n > 0 else 0
+
+    def __len__(self):
+        return self.count
+
+    def update(self, i, free):
+        """Cell index i became free (or not)."""
+        k = self.slot[i]
+        if k < 0 or self.free[k] == free:
+            return
+        self.free[k] = free
+        d = 1 if free else -1
+        self.count += d
+        n = len(self.cells)
+        k += 1
+        while k <= n:
+            self.tree[k] += d
+            k += k & -k
+
+    def select(self, k):
+        """Cell index of the k-th free cell (from 0), in list order."""
+        tree = self.tree
+        n = len(self.cells)
+        pos = 0
+        step = self.top
+        while step > 0:
+            if pos + step <= n and tree[pos + step] <= k:
+                pos += step
+                k -= tree[pos]
+            step >>= 1
+        return self.cells[pos]
+
+
+# Tables of the worlds of each size (see World.buildTables), and how many sizes to keep:
+sharedTables = {}
+MAXSHAREDTABLES = 4
+
+
 class World:
     """A World object contains a view of the game world.
 
@@ -49,20 +333,115 @@ class World:
     It includes methods to query and manipulate cell contents,
     but also useful methods to manipulate points and compute distances
     in the toroidal world.
+
+    In grid mode (grid=True), the world also keeps a flat bytearray, .grid,
+    with the type code of each cell (EMPTYCELL, WALLCELL, FOODCELL, BODYCELL),
+    indexed by .index(p) = x + y*width.  The dicts .walls, .food and .bodies
+    are kept in sync with it, so both representations may be used.
     """
     
-    def __init__(self, size, seed=None):
-        logging.debug("Creating World(size={!r}, seed={!r})".format(size, seed))
+    def __init__(self, size, seed=None, grid=False):
+        logging.debug("Creating World(size=%r, seed=%r, grid=%r)", size, seed, grid)
         self.rnd = random.Random(seed)  # random generator to use in this world
         self.size = size
-        self.walls = {}
-        self.food = {}
-        self.foodQueue = {t: deque() for t in FOODTYPES} # queues of foods of each type
-        self.bodies = {}
-        self.cells = ChainMap(self.bodies, self.food, self.walls)
+        self.buildTables()
+        if grid:
+            self.grid = bytearray(size.x*size.y)    # all EMPTYCELL
+            self.walls = CellMap(self, WALLCELL)
+            self.food = CellMap(self, FOODCELL, spatial=True)
+            self.bodies = CellMap(self, BODYCELL, spatial=True)
+            self.cells = GridCells(self)
+        else:
+            self.grid = None
+            self.walls = {}
+            self.food = {}
+            self.bodies = {}
+            self.cells = ChainMap(self.bodies, self.food, self.walls)
+        # foods of each type, from the one that has not moved for the longest
+        # (OrderedDicts used as queues, with O(1) removal of any food)
+        self.foodQueue = {t: OrderedDict() for t in FOODTYPES}
         
         self.foodfield = []
         self.playerfield = []
+        self.samplers = {}  # FreeCells of the foodfield, playerfield and whole map (see sampler)
+    
+    # Methods to access the grid (cell indices and cell type codes)
+    def index(self, p):
+        """Index of point p in the grid. (Wraps coords around.)"""
+        return p[0]%self.size.x + p[1]%self.size.y*self.size.x
+
+    def cellType(self, p):
+        """Type code of the contents of cell p (EMPTYCELL, WALLCELL, etc.)."""
+        if self.grid is not None:
+            return self.grid[self.index(p)]
+        p = self.normalize(p)
+        if p in self.bodies: return BODYCELL
+        if p in self.food: return FOODCELL
+        if p in self.walls: return WALLCELL
+        return EMPTYCELL
+
+    def isWall(self, p):
+        """True if there is a wall in cell p."""
+        if self.grid is not None:
+            return self.grid[self.index(p)] == WALLCELL
+        return self.normalize(p) in self.walls
+
+    def isFree(self, p):
+        """True if cell p is empty (no wall, food or body)."""
+        if self.grid is not None:
+            return self.grid[self.index(p)] == EMPTYCELL
+        return self.normalize(p) not in self.cells
+
+    def within(self, env, center, radius):
+        """Return a dict with the entries of env within distance radius of center.
+
+        env is one of the world's dicts (e.g. .food or .bodies).
+        If it keeps a spatial index, only the cells near center are examined.
+        """
+        dist = self.dist
+        spatial = getattr(env, 'spatial', None)
+        if spatial is None:
+            return {p: v for p, v in env.items() if dist(p, center) <= radius}
+        return {p: env[p] for p in spatial.near(center, radius) if dist(p, center) <= radius}
+
+    def updateCell(self, p):
+        """Recompute the grid code of cell p from the walls, food and bodies dicts."""
+        if p in self.bodies:
+            code = BODYCELL
+        elif p in self.food:
+            code = FOODCELL
+        elif p in self.walls:
+            code = WALLCELL
+        else:
+            code = EMPTYCELL
+        i = self.index(p)
+        self.grid[i] = code
+        if code == EMPTYCELL and self.samplers:
+            self.cellChanged(i, True)
+
+    def cellChanged(self, i, free):
+        """Cell index i became free (or not): update the samplers."""
+        for (_, _, sampler) in self.samplers.values():
+            sampler.update(i, free)
+
+    def sampler(self, cells=None):
+        """FreeCells of the foodfield or playerfield (cells is one of them),
+        or of the whole map if cells is None.  In grid mode only.
+        """
+        if cells is None:
+            key = "map"
+        elif cells is self.foodfield:
+            key = "foodfield"
+        else:
+            assert cells is self.playerfield
+            key = "playerfield"
+        n = len(cells) if cells is not None else len(self.grid)
+        entry = self.samplers.get(key)
+        if entry is None or entry[0] is not cells or entry[1] != n:
+            # (built again if the field was replaced or points were added to it)
+            indices = range(n) if cells is None else [self.index(p) for p in cells]
+            entry = self.samplers[key] = (cells, n, FreeCells(self, indices))
+        return entry[2]
     
     def put(self, pos, content):
         assert isinstance(pos, Point)
@@ -71,7 +450,7 @@ class World:
             self.walls[pos] = content
         elif content in FOODTYPES:
             self.food[pos] = content
-            self.foodQueue[t].append(p)
+            self.foodQueue[content][pos] = None
         else:
             self.bodies[pos] = content
     
@@ -82,7 +461,10 @@ class World:
     # Methods to manipulate points and coords in the world
     def normalize(self, p):
         """Normalize point p. (Wrap coords around this toroidal world.)"""
-        return Point(p[0]%self.size.x, p[1]%self.size.y)
+        try:
+            return self.points[p[1]][p[0]]
+        except IndexError:
+            return Point(p[0]%self.size.x, p[1]%self.size.y)
     
     def point(self, x, y):
         """Create a normalized Point from separate coords."""
@@ -91,13 +473,69 @@ class World:
     
     def dist(self, p1, p2):
         """Distance between points in this world. (Manhattan distance.)"""
-        d = abs(self.normalize(p2) - self.normalize(p1))
-        return min(d.x, self.size.x-d.x) + min(d.y, self.size.y-d.y)
+        try:
+            return self.xdist[p2[0]-p1[0]] + self.ydist[p2[1]-p1[1]]
+        except IndexError:
+            d = abs(Point(p2[0]%self.size.x, p2[1]%self.size.y) - Point(p1[0]%self.size.x, p1[1]%self.size.y))
+            return min(d.x, self.size.x-d.x) + min(d.y, self.size.y-d.y)
     
     def translate(self, p, d):
         """Point obtained by adding vector d to point p."""
-        p = self.normalize(p)   # not needed if isinstance(p, Point)
-        return self.normalize(p+d)
+        try:
+            return self.points[p[1]+d[1]][p[0]+d[0]]
+        except IndexError:
+            return Point((p[0]+d[0])%self.size.x, (p[1]+d[1])%self.size.y)
+
+    def cellPoint(self, i):
+        """The (normalized) Point of the cell with grid index i."""
+        return self.points[i//self.size.x][i%self.size.x]
+
+    def buildTables(self):
+        """Precompute the tables used to translate points and compute distances.
+
+        .points[y][x] is the normalized Point for any x in [-2*width, 2*width)
+        and y in [-2*height, 2*height), so adding a small vector to a
+        normalized point never needs the modulo operator.
+        .xdist[dx] and .ydist[dy] are the wrapped distances along each axis,
+        for any difference of coords in that same range.
+        These tables are tuples, shared by all worlds of the same size
+        (the wrapped rows and columns reuse the same W*H Point objects).
+        """
+        tables = sharedTables.get(self.size)
+        if tables is None:
+            (W, H) = self.size
+            new = tuple.__new__     # (much faster than Point(x, y))
+            xs = list(range(W))     # (the same int objects in every row)
+            rows = []
+            for y in range(H):
+                row = tuple([new(Point, (x, y)) for x in xs])
+                rows.append(row + row)
+            rows = tuple(rows)
+            xdist = tuple([min(d%W, W-d%W) for d in range(4*W)])
+            ydist = tuple([min(d%H, H-d%H) for d in range(4*H)])
+            tables = (rows + rows, xdist, ydist)
+            if len(sharedTables) >= MAXSHAREDTABLES:
+                del sharedTables[next(iter(sharedTables))]
+            sharedTables[self.size] = tables
+        (self.points, self.xdist, self.ydist) = tables
+        self.neighbourTables = None     # built when first needed (see neighbours)
+
+    @property
+    def neighbours(self):
+        """.neighbours[a][i] is the grid index of the cell reached from cell i
+        by doing ACTIONS[a].  (Built on first use: many worlds never need it.)
+        """
+        if self.neighbourTables is None:
+            (W, H) = self.size
+            self.neighbourTables = []
+            for d in ACTIONS:
+                xs = [(x+d.x)%W for x in range(W)]
+                table = array('i')
+                for y in range(H):
+                    base = (y+d.y)%H*W
+                    table.extend([base+x for x in xs])
+                self.neighbourTables.append(table)
+        return self.neighbourTables
 
     def randCoords(self):
         """Return a random point in this world."""
@@ -106,24 +544,51 @@ class World:
     def generatePos(self, forbiden={}, preferred={}):
         """Generate a position guaranteed not to be in forbiden.
         Chosen randomly from the preferred positions, or from the full range.
+        Raises NoFreeCell if every position is forbiden.
         """
-        preflist = [p for p in preferred if p not in forbiden]
-        if len(preflist) > 0:
-            pos = self.rnd.choice(preflist)
+        if forbiden is self.cells and self.grid is not None and \
+                (preferred is self.foodfield or preferred is self.playerfield):
+            # Free cells of the field, kept up to date
+            free = self.sampler(preferred) if preferred else ()
+            if len(free) > 0:
+                pos = self.cellPoint(free.select(self.rnd.randrange(len(free))))
+                assert pos not in forbiden
+                return pos
         else:
-            while True:
-                pos = self.randCoords()
-                if pos not in forbiden: break
-        assert pos not in forbiden
-        return pos
+            preflist = [p for p in preferred if p not in forbiden]
+            if len(preflist) > 0:
+                return self.rnd.choice(preflist)
+        for _ in range(MAXTRIES):
+            pos = self.randCoords()
+            if pos not in forbiden:
+                return pos
+        # Few positions left: choose one of them
+        if forbiden is self.cells and self.grid is not None:
+            free = self.sampler()
+            if len(free) > 0:
+                return self.cellPoint(free.select(self.rnd.randrange(len(free))))
+        else:
+            left = [p for p in map(self.cellPoint, range(self.size.x*self.size.y)) if p not in forbiden]
+            if len(left) > 0:
+                return self.rnd.choice(left)
+        raise NoFreeCell("No free position in the world.")
 
     def generatePlayerBody(self, t):
-        body = []
-        while True: ## TODO: possibility of infinite loop?
-            body.append(self.generatePos(forbiden=self.cells, preferred=self.playerfield))
-            neighboors = [self.translate(body[0],d) for d in DIRECTIONS]
-            body.append(self.generatePos(forbiden=self.cells, preferred=neighboors))
-            if len(body)==2: break
+        """Generate a body for player t in two adjacent free cells and return it."""
+        head = self.generatePos(forbiden=self.cells, preferred=self.playerfield)
+        neighbours = [p for p in (self.translate(head, d) for d in DIRECTIONS) if p not in self.cells]
+        if len(neighbours) == 0:
+            # Choose the head among the free cells with a free neighbour
+            # (in the playerfield, if possible)
+            cells = [p for p in self.playerfield if p not in self.cells]
+            if len(cells) == 0:
+                cells = [p for p in map(self.cellPoint, range(self.size.x*self.size.y)) if p not in self.cells]
+            cells = [p for p in cells if any(self.translate(p, d) not in self.cells for d in DIRECTIONS)]
+            if len(cells) == 0:
+                raise NoFreeCell("No room for the body of {}.".format(t))
+            head = self.rnd.choice(cells)
+            neighbours = [p for p in (self.translate(head, d) for d in DIRECTIONS) if p not in self.cells]
+        body = [head, self.rnd.choice(neighbours)]
         for p in body:
             self.put(p, t)
         return body
@@ -132,52 +597,74 @@ class World:
         """Create food of type t and return its position."""
         p = self.generatePos(forbiden=self.cells, preferred=self.foodfield)
         self.food[p] = t
-        self.foodQueue[t].append(p)
+        self.foodQueue[t][p] = None
         return p
     
     def eatFood(self, p):
         """Eat the food in position p and return its type."""
         t =  self.food.pop(p)
-        self.foodQueue[t].remove(p)
+        del self.foodQueue[t][p]
         return t
     
     def moveFood(self, t):
-        """Move a piece of food of type t."""
-        p = self.foodQueue[t].popleft()  # food that has not moved for the longest
+        """Move a piece of food of type t.  Return its old and new positions."""
+        (p, _) = self.foodQueue[t].popitem(last=False)  # food that has not moved for the longest
         t2 = self.food.pop(p)
         assert t2 == t
-        newpos = [self.translate(p, d) for d in ACTIONS]
-        #newpos = {self.translate(p, d): t for d in ACTIONS}
-        assert p not in self.cells # current position must be free now
-        assert p in newpos         # current position is always a valid option
-        p2 = self.generatePos(forbiden=self.cells, preferred=newpos)
+        # Stay or move to a free neighbour (candidates in ACTIONS order)
+        i = self.index(p)
+        if self.grid is not None:
+            grid = self.grid
+            assert grid[i] == EMPTYCELL # current position must be free now
+            free = [j for j in (table[i] for table in self.neighbours) if grid[j] == EMPTYCELL]
+            p2 = self.cellPoint(self.rnd.choice(free))
+        else:
+            assert p not in self.cells  # current position must be free now
+            newpos = [self.cellPoint(table[i]) for table in self.neighbours]
+            p2 = self.rnd.choice([q for q in newpos if q not in self.cells])
         self.food[p2] = t
-        self.foodQueue[t].append(p2)
-        logging.debug("Moving {}->{}".format(p, p2))
+        self.foodQueue[t][p2] = None
+        logging.debug("Moving %s->%s", p, p2)
+        return (p, p2)
                         
-    def loadField(self, pxarray):
-        for x in range(len(pxarray)):
-            for y in range(len(pxarray[x])):
-                p = pxarray[x][y] & 0xFFFFFF
-                if p == 0x00F900:   #food
-                    self.foodfield.append(Point(x,y))
-                elif p == 0xFF2600: #player
-                    self.playerfield.append(Point(x,y))
-                elif p == 0xAA7942: #wall
-                    self.walls[Point(x, y)] = WALL
-                elif p == 0xFFFFFF: #empty
-                    pass
-                else:   # not in [0xFF000000, 0]: #oldwall, oldempty 
-                    logging.error("UNKNOWN color: {:02X}".format(p))
+    def loadField(self, field):
+        """Load the walls, foodfield and playerfield from a mapfile.Field
+        (or from a pygame PixelArray, as in older versions)."""
+        if not isinstance(field, mapfile.Field):
+            field = mapfile.fromPixelArray(field)
+        (W, H) = self.size
+        assert (field.width, field.height) == (W, H)
+        # Positions column by column (in the order of the old pixel loops),
+        # found with bytes operations instead of a loop over all the cells
+        columns = b"".join(field.cells[x::W] for x in range(W))
+        points = self.points
+        def positions(code):
+            return [points[j%H][j//H] for j in compress(range(W*H), columns.translate(mapfile.mask(code)))]
+        self.foodfield.extend(positions(mapfile.FOOD))
+        self.playerfield.extend(positions(mapfile.PLAYER))
+        walls = positions(mapfile.WALL)
+        if isinstance(self.walls, CellMap):
+            self.walls.fill(walls, WALL)
+        else:
+            self.walls.update(dict.fromkeys(walls, WALL))
     
-    def saveField(self, pxarray):
-        pxarray[:,:] = 0xFFFFFF
-        for pos in self.walls:
-            pxarray[pos] = 0xAA7942
-        for pos in self.foodfield:
-            pxarray[pos] = 0x00F900
-        for pos in self.playerfield:
-            pxarray[pos ] = 0xFF2600
+    def saveField(self, pxarray=None):
+        """Return a mapfile.Field with the walls, foodfield and playerfield
+        (and draw them in pxarray, a pygame PixelArray, if given)."""
+        cells = bytearray(self.size.x*self.size.y)  # all mapfile.EMPTY
+        for (positions, code) in [(self.walls, mapfile.WALL), (self.foodfield, mapfile.FOOD),
+                                  (self.playerfield, mapfile.PLAYER)]:
+            for pos in positions:
+                cells[self.index(pos)] = code
+        if pxarray is not None:
+            pxarray[:,:] = 0xFFFFFF
+            for pos in self.walls:
+                pxarray[pos] = 0xAA7942
+            for pos in self.foodfield:
+                pxarray[pos] = 0x00F900
+            for pos in self.playerfield:
+                pxarray[pos ] = 0xFF2600
+        return mapfile.Field(self.size.x, self.size.y, bytes(cells))
         
     def generateWalls(self, level):
         for i in range(1,level+1):
@@ -224,8 +711,17 @@ ACTIONS = [Stay] + DIRECTIONS           # Stay is always ACTIONS[0]
 ## Cell contents
 WALL = 'W'
 FOODTYPES = list(FOODCOLOR.keys())
+
+## Cell type codes in the grid (in increasing order of precedence)
+EMPTYCELL = 0
+WALLCELL = 1
+FOODCELL = 2
+BODYCELL = 3
 #BODYTYPES = ['P0', 'P1'] # = agent names
 
+## Random positions tried by generatePos before choosing among the free ones
+MAXTRIES = 100
+
 
 ## TESTS
 
@@ -255,3 +751,81 @@ if __name__ == "__main__":
     assert r == Point(9,0)          # It's the same as top right
     print(r)
     
+    g = World(Point(10,10), grid=True)  # A world with a compact grid
+    g.walls[Point(1,1)] = WALL          # Changing the dicts updates the grid
+    g.food[Point(2,2)] = 'M'
+    assert g.isWall(Point(1,1)) and g.isWall(Point(11,-9))
+    assert g.cellType(Point(2,2)) == FOODCELL
+    g.bodies[Point(2,2)] = 'P0'         # A body over food covers it...
+    assert g.cellType(Point(2,2)) == BODYCELL
+    g.food.pop(Point(2,2))              # ...even after the food is eaten
+    assert g.cellType(Point(2,2)) == BODYCELL
+    g.bodies.pop(Point(2,2))
+    assert g.isFree(Point(2,2)) and Point(2,2) not in g.cells
+    assert Point(1,1) in g.cells and g.get(Point(1,1)) == WALL
+    assert g.grid.count(EMPTYCELL) == 99
+    
+    # Spatial queries give the same results as a full scan
+    g = World(Point(30,20), seed=1, grid=True)
+    for k in range(100):
+        g.food[g.randCoords()] = 'S'
+    for c in [Point(0,0), Point(29,19), Point(15,3)]:
+        for r in [0, 1, 5, 9, 10, 20, 30]:
+            scan = {p: v for p, v in g.food.items() if g.dist(p, c) <= r}
+            assert g.within(g.food, c, r) == scan
+            v = HorizonView(g, g.food, c, r)
+            assert all((p in v) == (p in scan) for p in g.food)
+            assert dict(v) == scan and len(v) == len(scan)
+            assert not hasattr(v, 'env') and not hasattr(v, 'world')
+    
+    # Tables give the same results as the modular arithmetic
+    w = World(Point(7,5))
+    for x in range(-14, 14):
+        for y in range(-10, 10):
+            p = Point(x,y)
+            for d in ACTIONS:
+                assert w.translate(p, d) == Point((x+d.x)%7, (y+d.y)%5)
+            for q in [Point(0,0), Point(6,4), Point(3,2)]:
+                (dx, dy) = (abs(x%7-q.x), abs(y%5-q.y))
+                assert w.dist(p, q) == min(dx, 7-dx) + min(dy, 5-dy)
+    assert w.translate(Point(100,-100), Left) == Point(1,0)
+    assert w.dist(Point(100,-100), Point(0,0)) == 2+0
+    for i in range(7*5):
+        p = w.cellPoint(i)
+        assert w.index(p) == i
+        for a, d in enumerate(ACTIONS):
+            assert w.neighbours[a][i] == w.index(w.translate(p, d))
+    
+    
+    # Random draws from the free cells pick the same cells as rnd.choice
+    g = World(Point(20,10), seed=3, grid=True)
+    g.foodfield = [g.randCoords() for k in range(150)]
+    g.foodfield = list(dict.fromkeys(g.foodfield))  # (without repetitions)
+    for k in range(300):
+        p = g.randCoords()
+        if p in g.food:
+            g.food.pop(p)
+        elif p not in g.bodies:
+            g.bodies[p] = 'P0'
+        state = g.rnd.getstate()
+        preflist = [p for p in g.foodfield if p not in g.cells]
+        expected = g.rnd.choice(preflist) if preflist else None
+        g.rnd.setstate(state)
+        if expected is not None:
+            assert g.generateFood('S') == expected
+    # A replaced field (even with the same length) gets a new sampler
+    g.foodfield = [g.cellPoint(i) for i in range(len(g.foodfield))]
+    free = [p for p in g.foodfield if p not in g.cells]
+    assert free and g.generateFood('S') in free
+    # A full world raises NoFreeCell (instead of looping forever)
+    g = World(Point(5,4), seed=3, grid=True)
+    for k in range(5*4 - 3):
+        g.generateFood('M')
+    g.generatePlayerBody('P0')
+    g.generateFood('S')
+    assert len(g.cells) == 5*4
+    try:
+        g.generateFood('S')
+        assert False
+    except NoFreeCell:
+        pass